@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Admission control, so a surge of clients degrades service instead of
+exhausting threads.
+
+Streams and long polls are limited per game, per client and in total. Requests changing a
+game wait in a bounded queue for its lock, see gamedb.LockManager. Both fail
+fast with Overloaded, which the API turns into 503 with Retry-After.
+"""
+
+from threading import Lock
+import stats
+
+
+class Overloaded(Exception):
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StreamTicket:
+
+    def __init__(self, limits, code: str, client: str):
+        self.limits = limits
+        self.code = code
+        self.client = client
+        self.released = False
+
+
+    def release(self) -> None:
+        # Called once when the stream ends and again when the response is
+        # closed, whichever comes first does the work
+        if not self.released:
+            self.released = True
+            self.limits._release(self.code, self.client)
+
+
+class StreamLimits:
+    """
+    Limits on concurrent streams. A limit of None is disabled.
+
+    Clients are told apart by address, so the per client limit is off by
+    default: players behind one NAT share an address. Behind a reverse
+    proxy, the address is only the client's if the proxy headers are
+    trusted, see web.py --proxies or uvicorn --proxy-headers.
+    """
+
+    def __init__(self, per_game: int = 200, per_client: int = None,
+            total: int = 10000, retry_after: int = 5):
+        self.per_game = per_game
+        self.per_client = per_client
+        self.total = total
+        self.retry_after = retry_after
+        self._mutex = Lock()
+        self._games = {}
+        self._clients = {}
+        self._count = 0
+
+
+    def admit(self, code: str, client: str) -> StreamTicket:
+        """
+        Reserve a stream for a client, raising Overloaded if any limit is
+        reached. Release the returned ticket when the stream ends.
+        """
+        with self._mutex:
+            if _reached(self._count, self.total):
+                reason = 'total'
+            elif _reached(self._games.get(code, 0), self.per_game):
+                reason = 'game'
+            elif _reached(self._clients.get(client, 0), self.per_client):
+                reason = 'client'
+            else:
+                self._count += 1
+                self._games[code] = self._games.get(code, 0) + 1
+                self._clients[client] = self._clients.get(client, 0) + 1
+                return StreamTicket(self, code, client)
+        stats.increment('admission_rejected_total', kind=f'stream_{reason}')
+        raise Overloaded(f'Too many streams ({reason})', self.retry_after)
+
+
+    def count(self) -> int:
+        return self._count
+
+
+    def _release(self, code: str, client: str) -> None:
+        with self._mutex:
+            self._count -= 1
+            _decrement(self._games, code)
+            _decrement(self._clients, client)
+
+
+def _reached(count: int, limit: int) -> bool:
+    return limit is not None and count >= limit
+
+
+def _decrement(counts: dict, key: str) -> None:
+    counts[key] -= 1
+    if counts[key] == 0:
+        del counts[key]
+
+
+streams = StreamLimits()
+
+stats.gauge('admission_streams', lambda: streams.count())
+
+
+def configure(streams_per_game: int = None, streams_per_client: int = None,
+        streams_total: int = None) -> None:
+    if streams_per_game is not None:
+        streams.per_game = streams_per_game
+    if streams_per_client is not None:
+        streams.per_client = streams_per_client
+    if streams_total is not None:
+        streams.total = streams_total
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
-import random
 import sys
 import time
-import json
 from flask import Flask, redirect, url_for, render_template, request, session, \
-        Blueprint, Response
-from game import Game
+        Blueprint, Response, current_app, g
+from game import GameException
+import admission
+import cluster
+import encoding
 import gamedb
+import stats
+from views import views
 
 
 def eprint(*args, **kwargs):
@@ -15,6 +18,49 @@ def eprint(*args, **kwargs):
 
 
 api = Blueprint('api', __name__)
+# Views of archived games can't be asked for again
+gamedb.archive_listeners.append(views.discard)
+
+# Seconds between keep-alive comments on an idle stream
+STREAM_KEEPALIVE = 10
+# Longest a poll with ?wait= is held
+LONG_POLL_MAX = 60
+
+
+@api.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@api.before_request
+def forward_to_owner():
+    # Streams only read the game, any worker can serve them
+    code = (request.view_args or {}).get('code')
+    if code is None or request.endpoint == 'api.stream_game_info' or \
+            cluster.cluster.owns(code):
+        return None
+    # Long polls are held by the owner
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX)
+    status, headers, body = cluster.cluster.forward(code, request.method,
+            request.full_path if request.query_string else request.path,
+            request.headers, request.get_data(), cluster.FORWARD_TIMEOUT + wait)
+    headers = [(k, v) for k, v in headers if k.lower() not in
+            ('connection', 'content-length', 'transfer-encoding', 'server', 'date')]
+    return Response(body, status, headers)
+
+
+@api.after_request
+def record_request_time(response):
+    stats.observe('api_request_seconds', time.perf_counter() - g.request_start,
+            endpoint=request.endpoint)
+    stats.increment('api_responses_total', endpoint=request.endpoint,
+            status=response.status_code)
+    return response
+
+
+@api.errorhandler(admission.Overloaded)
+def handle_overloaded(e):
+    return {'message': str(e)}, 503, {'Retry-After': str(e.retry_after)}
 
 
 @api.errorhandler(405)
@@ -27,16 +73,24 @@ def index():
     return {}
 
 
+@api.route('/stats/')
+def get_stats():
+    return stats.registry.to_dict()
+
+
+@api.route('/metrics')
+def get_metrics():
+    return Response(stats.registry.to_prometheus(),
+            mimetype='text/plain; version=0.0.4')
+
+
 @api.route('/create/', methods=['POST'])
 def create_game():
     name = request.form.get('name')
     if name is None:
         return {'message': f'Name field is not found or empty'}, 400
-    code = None
-    while code is None or gamedb.load_game(code) is not None:
-        code = ''.join((random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(6)))
-    with gamedb.lock:
-        gamedb.create_game(code)
+    code = gamedb.new_game()
+    with gamedb.lock(code):
         game = gamedb.load_game(code)
         game.add_player(name)
         gamedb.save_game(code, game)
@@ -46,16 +100,51 @@ def create_game():
 
 @api.route('/info/<string:code>/')
 def get_game_info(code: str):
-    game = gamedb.load_game(code)
-    if game is None:
-        return {'message': f'Game {code} not found'}, 404
+    """
+    The game version is sent as ETag. If it matches If-None-Match, ?wait=
+    holds the request for up to that many seconds until the game changes,
+    otherwise or on timeout 304 is returned. Held requests are admitted like
+    streams.
+    """
     player = session.get(code)
-    return _parse_game_info(game, player)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX)
+    ticket = None
+    if wait > 0 and request.if_none_match:
+        # A held poll takes a thread like a stream, so it counts as one
+        ticket = admission.streams.admit(code, request.remote_addr)
+    try:
+        with gamedb.hub.subscribe(code) as subscription:
+            version = gamedb.load_version(code)
+            if version is None:
+                return {'message': f'Game {code} not found'}, 404
+            deadline = time.monotonic() + wait
+            while request.if_none_match.contains(str(version)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not subscription.wait(remaining):
+                    response = Response(status=304)
+                    response.set_etag(str(version))
+                    return response
+                version = gamedb.load_version(code)
+                if version is None:
+                    return {'message': f'Game {code} not found'}, 404
+    finally:
+        if ticket is not None:
+            ticket.release()
+    with gamedb.lock(code):
+        game = gamedb.load_view(code)
+        if game is None:
+            return {'message': f'Game {code} not found'}, 404
+        view = views.get(code, game, player)
+    response = Response(view.data, mimetype='application/json')
+    response.set_etag(str(game.version))
+    # The info depends on the player in the session
+    response.vary.add('Cookie')
+    return response
 
 
 @api.route('/action/<string:code>/', methods=['POST'])
 def perform_action(code: str):
-    with gamedb.lock:
+    with gamedb.lock.bounded(code):
         game = gamedb.load_game(code)
         if game is None:
             return {'message': f'Game {code} not found'}, 404
@@ -67,12 +156,44 @@ def perform_action(code: str):
     return {}, 200
 
 
+@api.route('/actions/<string:code>/', methods=['POST'])
+def perform_actions(code: str):
+    """
+    Perform a JSON list of actions with a single load and save of the game,
+    e.g. for a bot playing several players. Each entry holds an action and
+    optionally the session token of the player performing it, by default
+    the player of this session. Returns an empty object per successful
+    action, or one with a message.
+    """
+    entries = request.get_json(silent=True)
+    if type(entries) != list or not all(type(e) == dict and
+            type(e.get('action')) == dict and
+            type(e.get('session', '')) == str for e in entries):
+        return {'message': f'Expected a list of actions'}, 400
+    # The names are read before locking the game, one lookup per session
+    store = current_app.session_interface.store
+    names = {t: store.get(t, code) for t in
+            {e['session'] for e in entries if 'session' in e}}
+    players = [names[e['session']] if 'session' in e else session.get(code)
+            for e in entries]
+    with gamedb.lock.bounded(code):
+        game = gamedb.load_game(code)
+        if game is None:
+            return {'message': f'Game {code} not found'}, 404
+        results = game.perform_actions((p, e['action'])
+                for p, e in zip(players, entries) if p is not None)
+        gamedb.save_game(code, game)
+    results = iter(results)
+    return {'results': [{'message': f'Name is not set'} if p is None else
+            _action_result(next(results)) for p in players]}, 200
+
+
 @api.route('/join/<string:code>/', methods=['POST'])
 def join_game(code: str):
     name = request.form.get('name')
     if name is None:
         return {'message': f'Name field is not found or empty'}, 400
-    with gamedb.lock:
+    with gamedb.lock.bounded(code):
         game = gamedb.load_game(code)
         if game is None:
             return {'message': f'Game {code} not found'}, 404
@@ -93,7 +214,7 @@ def join_game(code: str):
 
 @api.route('/start/<string:code>/', methods=['POST'])
 def start_game(code: str):
-    with gamedb.lock:
+    with gamedb.lock.bounded(code):
         game = gamedb.load_game(code)
         if game is None:
             return {'message': f'Game {code} not found'}, 404
@@ -106,29 +227,45 @@ def start_game(code: str):
 
 @api.route('/stream/<string:code>/')
 def stream_game_info(code: str):
+    """
+    Stream the game info as server-sent events, with the game version as the
+    event id. A client reconnecting with a Last-Event-ID equal to the
+    current version doesn't get the info sent again. With ?delta=1 only the
+    first event holds the full info, later 'delta' events hold the fields
+    that changed, with removed fields set to null.
+    """
     player = session.get(code)
+    delta = request.args.get('delta', '0') not in ('', '0')
+    version = request.headers.get('Last-Event-ID')
+    version = int(version) if version is not None and version.isdigit() else None
+    ticket = admission.streams.admit(code, request.remote_addr)
     def stream():
         try:
-            serialized = None
-            counter = 0
-            while True:
-                serialized_now = gamedb.load_game_raw(code)
-                if serialized_now is None:
-                    return {'message': f'Game {code} not found'}, 404
-                if serialized_now != serialized:
-                    if __debug__:
-                        eprint(f'Sending info for game {code}')
-                    print(_parse_game_info(Game(serialized_now), player))
-                    yield 'data: ' + json.dumps(
-                            _parse_game_info(Game(serialized_now), player),
-                            separators=(',',':')) + \
-                            '\n\n'
-                    serialized = serialized_now
-                counter += 1
-                if counter % 10 == 0:
-                    yield ':\n\n'
-                time.sleep(1)
+            sent = None
+            last_version = version
+            with gamedb.hub.subscribe(code) as subscription:
+                while True:
+                    update = _load_game_update(code, player, last_version)
+                    if update is None:
+                        return
+                    last_version, view = update
+                    if view is not None:
+                        if __debug__:
+                            eprint(f'Sending info for game {code}')
+                        if delta and sent is not None:
+                            yield _event(_encode(_diff(sent, view.info)),
+                                    last_version, 'delta')
+                        else:
+                            yield _event(view.data, last_version)
+                        sent = view.info
+                    elif sent is None:
+                        # Resumed at the current version, the client still
+                        # needs the headers now
+                        yield b':\n\n'
+                    while not subscription.wait(STREAM_KEEPALIVE):
+                        yield b':\n\n'
         finally:
+            ticket.release()
             if __debug__:
                 msg = f'Stopped stream for game {code} - '
                 if player is not None:
@@ -136,16 +273,51 @@ def stream_game_info(code: str):
                 else:
                     msg += 'no player'
                 eprint(msg)
-    return Response(stream(), mimetype='text/event-stream')
-
-
-def _parse_game_info(game: Game, player: str = None):
-    d = {
-            'activity': game.activity,
-            'players': list(game.player_roles),
-        }
-    if player is not None:
-        d['name'] = player
-    if player is not None or game.activity == 'finished':
-        d['state'] = game.get_info(player)
+    response = Response(stream(), mimetype='text/event-stream')
+    # The generator doesn't run its finally if it never started
+    response.call_on_close(ticket.release)
+    return response
+
+
+def _load_game_update(code: str, player: str, version: int):
+    """
+    Returns the current version of the game and its view, or None as view if
+    the version hasn't changed. Returns None if the game doesn't exist.
+    """
+    with gamedb.lock(code):
+        game = gamedb.load_view(code)
+        if game is None:
+            return None
+        if game.version == version:
+            return version, None
+        return game.version, views.get(code, game, player)
+
+
+def _action_result(result) -> dict:
+    if isinstance(result, GameException):
+        return {'message': str(result)}
+    return {}
+
+
+def _event(data: bytes, id: int, event: str = None) -> bytes:
+    frame = f'id: {id}\n'
+    if event is not None:
+        frame += f'event: {event}\n'
+    return frame.encode() + b'data: ' + data + b'\n\n'
+
+
+def _encode(data: dict) -> bytes:
+    return encoding.dumps(data)
+
+
+def _diff(old: dict, new: dict):
+    d = {k: None for k in old if k not in new}
+    for k, v in new.items():
+        o = old.get(k)
+        if type(o) == dict and type(v) == dict:
+            if o != v:
+                d[k] = _diff(o, v)
+        elif k not in old or o != v:
+            d[k] = v
     return d
+
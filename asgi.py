@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+ASGI entry point, e.g. `uvicorn asgi:app`.
+
+Streams are served by coroutines waiting on the change hub, so an idle
+subscriber doesn't hold a thread. All other requests are passed on to the
+Flask application, which requires asgiref.
+"""
+
+import asyncio
+import re
+import sys
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+import admission
+import api
+import encoding
+import gamedb
+from web import app as flask_app
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as e:
+    raise ImportError('asgi.py needs asgiref to serve the Flask application, '
+            'install it with `pip install asgiref`') from e
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+STREAM_PATH = re.compile(r'^/api/stream/([^/]+)/$')
+# The server makes send() wait once its write buffer for a client is full.
+# Streams to clients that don't catch up within this many seconds are closed.
+STREAM_SEND_TIMEOUT = 10
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+class CookieRequest:
+    """
+    Just enough of a request for Flask's session interface to read the
+    session cookie.
+    """
+
+    def __init__(self, headers: dict):
+        cookie = SimpleCookie(headers.get('cookie', ''))
+        self.cookies = {k: v.value for k, v in cookie.items()}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    match = STREAM_PATH.match(scope['path'])
+    if match is not None and scope['method'] == 'GET':
+        await stream_game_info(scope, receive, send, match.group(1))
+    else:
+        await wsgi_app(scope, receive, send)
+
+
+async def stream_game_info(scope, receive, send, code: str):
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+            for k, v in scope['headers']}
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    delta = query.get('delta', ['0'])[0] not in ('', '0')
+    version = headers.get('last-event-id')
+    version = int(version) if version is not None and version.isdigit() else None
+    client = scope.get('client')
+    try:
+        ticket = admission.streams.admit(code, '' if client is None else client[0])
+    except admission.Overloaded as e:
+        await _respond(send, 503, encoding.dumps({'message': str(e)}),
+                b'application/json',
+                [(b'retry-after', str(e.retry_after).encode())])
+        return
+    try:
+        await _stream(send, receive, code, headers, delta, version)
+    except asyncio.TimeoutError:
+        if __debug__:
+            eprint(f'Dropped slow stream for game {code}')
+    finally:
+        ticket.release()
+
+
+async def _stream(send, receive, code: str, headers: dict, delta: bool,
+        version: int):
+    loop = asyncio.get_running_loop()
+    with gamedb.hub.subscribe_async(code) as subscription:
+        player, update = await loop.run_in_executor(None, _open_stream, code,
+                headers, version)
+        if update is None:
+            await _respond(send, 404,
+                    f'{{"message":"Game {code} not found"}}'.encode(),
+                    b'application/json')
+            return
+        await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                        (b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                    ],
+            })
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            sent = None
+            while update is not None:
+                version, view = update
+                if view is not None:
+                    if delta and sent is not None:
+                        frame = api._event(api._encode(api._diff(sent, view.info)),
+                                version, 'delta')
+                    else:
+                        frame = api._event(view.data, version)
+                    await _send_body(send, frame)
+                    sent = view.info
+                elif sent is None:
+                    # Resumed at the current version, some servers only
+                    # send the headers with the first body
+                    await _send_body(send, b':\n\n')
+                while not await _wait_change(subscription, disconnected):
+                    if disconnected.done():
+                        return
+                    await _send_body(send, b':\n\n')
+                update = await loop.run_in_executor(None, api._load_game_update,
+                        code, player, version)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if __debug__:
+                eprint(f'Stopped async stream for game {code}')
+
+
+def _open_stream(code: str, headers: dict, version: int):
+    """
+    Return the player of the session and the first update. The session
+    store may be the database, so this runs in the executor too.
+    """
+    session = flask_app.session_interface.open_session(flask_app,
+            CookieRequest(headers))
+    player = None if session is None else session.get(code)
+    return player, api._load_game_update(code, player, version)
+
+
+async def _wait_change(subscription, disconnected) -> bool:
+    waiter = asyncio.ensure_future(subscription.wait(api.STREAM_KEEPALIVE))
+    await asyncio.wait((waiter, disconnected), return_when=asyncio.FIRST_COMPLETED)
+    if not waiter.done():
+        waiter.cancel()
+        return False
+    return waiter.result()
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_body(send, body: bytes):
+    await asyncio.wait_for(send({'type': 'http.response.body', 'body': body,
+            'more_body': True}), STREAM_SEND_TIMEOUT)
+
+
+async def _respond(send, status: int, body: bytes, content_type: bytes,
+        headers: list = ()):
+    await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type), *headers],
+        })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            gamedb.start_maintenance()
+            gamedb.start_timers()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            gamedb.maintenance.stop()
+            gamedb.timers.stop()
+            gamedb.cache.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the game engine.
+
+    ./engine.py [--output results.json] [--players 5,20,50,200]
+"""
+
+import argparse
+import json
+import random
+import sys
+import timeit
+sys.path.append("..")
+from game import Game
+
+
+def new_game(player_count: int) -> Game:
+    game = Game()
+    for i in range(player_count):
+        game.add_player(f'player{i}')
+    game.start()
+    return game
+
+
+def wolves_voted(player_count: int) -> Game:
+    """
+    A game in the vote activity, after the wolf killed a citizen.
+    """
+    game = new_game(player_count)
+    wolf = [p for p, r in game.player_roles.items() if r == 'wolf'][0]
+    victim = next(p for p in game.player_roles if p != wolf)
+    game.perform_action(wolf, {'player': victim})
+    return game
+
+
+def bench_perform_action(player_count: int):
+    game = wolves_voted(player_count)
+    alive = [p for p in game.player_roles if p not in game.dead_players]
+    # The last player never votes so the ballot never resolves and every
+    # call does the same amount of work.
+    voters = alive[:-1]
+    counter = [0]
+    def run():
+        i = counter[0] = counter[0] + 1
+        game.perform_action(voters[i % len(voters)], {'player': alive[i % 2]})
+    return run
+
+
+def bench_serialize(player_count: int, format: str):
+    game = wolves_voted(player_count)
+    return lambda: game.serialize(format)
+
+
+def bench_deserialize(player_count: int, format: str):
+    serialized = wolves_voted(player_count).serialize(format)
+    return lambda: Game(serialized)
+
+
+def bench_is_finished(player_count: int):
+    game = wolves_voted(player_count)
+    return game._is_finished
+
+
+def measure(function, min_time: float = 0.2) -> dict:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=5, number=number)) / number
+    return {'seconds_per_op': best, 'ops_per_second': 1 / best}
+
+
+def run(player_counts: list) -> dict:
+    results = {}
+    for n in player_counts:
+        random.seed(n)
+        benches = {
+                'perform_action': bench_perform_action(n),
+                'serialize_json': bench_serialize(n, 'json'),
+                'serialize_binary': bench_serialize(n, 'binary'),
+                'deserialize_json': bench_deserialize(n, 'json'),
+                'deserialize_binary': bench_deserialize(n, 'binary'),
+                'is_finished': bench_is_finished(n),
+            }
+        for name, function in benches.items():
+            result = measure(function)
+            results.setdefault(name, {})[n] = result
+            print(f'{name:20} {n:4} players  {result["seconds_per_op"] * 1e6:10.2f} us/op',
+                    file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--players', default='5,20,50,200',
+            help='comma separated player counts')
+    args = parser.parse_args()
+    results = {
+            'benchmark': 'engine',
+            'python': sys.version.split()[0],
+            'results': run([int(n) for n in args.players.split(',')]),
+        }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the API.
+
+Simulates a number of rooms with a number of players each, every player
+holding an open event stream, and plays all games to the end. Unless --url
+is given a server is started on a free port with a fresh database.
+
+    ./load.py [--rooms 20] [--players 8] [--url URL] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Lock, Thread
+import requests as req
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Recorder:
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.events = 0
+
+
+    def request(self, name: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        r = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self.mutex:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if r.status_code >= 400:
+                self.errors += 1
+        return r
+
+
+    def event(self):
+        with self.mutex:
+            self.events += 1
+
+
+    def summary(self, duration: float) -> dict:
+        ops = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            ops[name] = {
+                    'count': len(latencies),
+                    'p50': latencies[len(latencies) // 2],
+                    'p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+                }
+        total = sum(o['count'] for o in ops.values())
+        return {
+                'duration': duration,
+                'requests': total,
+                'requests_per_second': total / duration,
+                'errors': self.errors,
+                'stream_events': self.events,
+                'operations': ops,
+            }
+
+
+def start_server(directory: str) -> tuple:
+    """
+    Start a server on a free port. Returns the process and its URL.
+    """
+    with open(os.path.join(directory, 'secret.key'), 'w') as f:
+        f.write(os.urandom(16).hex())
+    subprocess.run([sys.executable, '-O', os.path.join(ROOT, 'gamedb.py')],
+            cwd=directory, check=True, stdout=subprocess.DEVNULL)
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-O', os.path.join(ROOT, 'web.py'),
+                '--port', str(port)],
+            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://localhost:{port}'
+    for _ in range(100):
+        if server.poll() is not None:
+            raise RuntimeError('Server exited')
+        try:
+            req.get(f'{url}/api/')
+            return server, url
+        except req.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not start')
+
+
+def open_stream(url: str, session: req.Session, recorder: Recorder):
+    # Refused streams, e.g. by the admission limits, count as errors
+    r = recorder.request('stream', session.get, url, stream=True)
+    if r.status_code != 200:
+        r.close()
+        return r
+    def read():
+        try:
+            for line in r.iter_lines():
+                if line.startswith(b'data:'):
+                    recorder.event()
+        except (req.RequestException, AttributeError):
+            # Closed by us when the game is over
+            pass
+    Thread(target=read, daemon=True).start()
+    return r
+
+
+def play_room(base_url: str, player_count: int, recorder: Recorder, counts: dict):
+    names = [f'player{i}' for i in range(player_count)]
+    sessions = {n: req.Session() for n in names}
+    owner = names[0]
+
+    r = recorder.request('create', sessions[owner].post, f'{base_url}/create/',
+            data={'name': owner})
+    code = r.json()['code']
+    for n in names[1:]:
+        recorder.request('join', sessions[n].post, f'{base_url}/join/{code}/',
+                data={'name': n})
+    streams = [open_stream(f'{base_url}/stream/{code}/', sessions[n], recorder)
+            for n in names]
+    recorder.request('start', sessions[owner].post, f'{base_url}/start/{code}/')
+
+    actions = 0
+    while True:
+        infos = {n: recorder.request('info', sessions[n].get,
+                f'{base_url}/info/{code}/').json() for n in names}
+        activity = infos[owner]['activity']
+        if activity == 'finished':
+            break
+        if activity == 'wolves':
+            wolves = [n for n, i in infos.items() if len(i['state']) > 0]
+            options = next(infos[w]['state']['options'] for w in wolves
+                    if len(infos[w]['state']['options']) > 0)
+            voters = [w for w in wolves if w in options]
+            target = next(o for o in options if o not in wolves)
+        else:
+            options = next(i['state']['options'] for i in infos.values()
+                    if len(i['state']['options']) > 0)
+            voters = options
+            target = options[-1]
+        for n in voters:
+            recorder.request('action', sessions[n].post, f'{base_url}/action/{code}/',
+                    data={'player': target})
+            actions += 1
+
+    # Closed by run() once the clock is stopped
+    with recorder.mutex:
+        counts['actions'] += actions
+        counts['rooms'] += 1
+        counts['streams'] += streams
+
+
+def run(base_url: str, rooms: int, players: int) -> dict:
+    recorder = Recorder()
+    counts = {'actions': 0, 'rooms': 0, 'streams': []}
+    statements = req.get(f'{base_url}/stats/').json().get('gamedb_statements_total', 0)
+    start = time.perf_counter()
+    threads = [Thread(target=play_room, args=(base_url, players, recorder, counts))
+            for _ in range(rooms)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+    # Closing a stream waits for its reader to wake up, which may take a
+    # keep-alive interval, so they are closed all at once
+    closers = [Thread(target=s.close) for s in counts['streams']]
+    for t in closers:
+        t.start()
+    for t in closers:
+        t.join()
+    stats = req.get(f'{base_url}/stats/').json()
+    statements = stats.get('gamedb_statements_total', 0) - statements
+    result = recorder.summary(duration)
+    result.update({
+            'rooms': rooms,
+            'players': players,
+            'rooms_finished': counts['rooms'],
+            'actions': counts['actions'],
+            # Of every request, not only the actions
+            'db_statements_per_request': statements / max(result['requests'], 1),
+            'server_stats': stats,
+        })
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--url', help='base URL of a running server')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    server = None
+    directory = tempfile.TemporaryDirectory()
+    url = args.url
+    if url is None:
+        server, url = start_server(directory.name)
+    base_url = url.rstrip('/') + '/api'
+    try:
+        results = {
+                'benchmark': 'load',
+                'python': sys.version.split()[0],
+                'results': run(base_url, args.rooms, args.players),
+            }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        directory.cleanup()
+
+    r = results['results']
+    print(f'{r["requests"]} requests in {r["duration"]:.2f}s, '
+            f'{r["requests_per_second"]:.1f}/s, {r["errors"]} errors, '
+            f'{r["db_statements_per_request"]:.2f} statements per request',
+            file=sys.stderr)
+    for name, op in r['operations'].items():
+        print(f'{name:8} {op["count"]:6}  p50 {op["p50"] * 1000:8.2f} ms  '
+                f'p99 {op["p99"] * 1000:8.2f} ms', file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+Support for running several worker processes on one database.
+
+Every game is owned by one worker, chosen by consistent hashing of its code.
+Only the owner modifies a game, so the per-game locks and the game cache of
+gamedb stay valid. Requests for games owned by another worker are forwarded
+to it, except streams which any worker can serve: changes are shared between
+workers through a fan-out and every worker reads the games from the shared
+database.
+"""
+
+import socket
+import sys
+import urllib.error
+import urllib.request
+from bisect import bisect
+from hashlib import blake2b
+import encoding
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+# Seconds a forwarded request may take, on top of how long it asks to be
+# held for
+FORWARD_TIMEOUT = 10
+
+
+class HashRing:
+
+    def __init__(self, nodes: list, replicas: int = 64):
+        points = []
+        for node in nodes:
+            for i in range(replicas):
+                points.append((_hash(f'{node}#{i}'), node))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+
+    def owner(self, key: str) -> str:
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class LocalFanOut:
+    """
+    In-memory fan-out, connecting hubs within a single process. Intended
+    for tests.
+    """
+
+    def __init__(self, broker: list):
+        self.broker = broker
+        self.callback = None
+
+
+    def start(self, callback) -> None:
+        self.callback = callback
+        self.broker.append(self)
+
+
+    def publish(self, code: str) -> None:
+        for fanout in list(self.broker):
+            if fanout is not self:
+                fanout.callback(code)
+
+
+class RedisFanOut:
+    """
+    Fan-out through the publish/subscribe channels of a Redis compatible
+    server. Requires the redis package.
+    """
+
+    def __init__(self, url: str, node: str, channel: str = 'werewolves'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.node = node
+        self.channel = channel
+        self.thread = None
+
+
+    def start(self, callback) -> None:
+        def handle(message):
+            node, code = message['data'].decode('utf-8').split(' ', 1)
+            if node != self.node:
+                callback(code)
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: handle})
+        self.thread = pubsub.run_in_thread(daemon=True)
+
+
+    def publish(self, code: str) -> None:
+        self.client.publish(self.channel, f'{self.node} {code}')
+
+
+class Cluster:
+
+    def __init__(self, node: str = None, nodes: dict = None):
+        """
+        nodes maps the name of every worker to its base URL, node is the
+        name of this worker. Without nodes this worker owns every game.
+        """
+        self.node = node
+        self.nodes = nodes or {}
+        self.ring = HashRing(sorted(self.nodes)) if len(self.nodes) > 0 else None
+
+
+    def owns(self, code: str) -> bool:
+        return self.ring is None or self.ring.owner(code) == self.node
+
+
+    def owner_url(self, code: str) -> str:
+        return self.nodes[self.ring.owner(code)]
+
+
+    def forward(self, code: str, method: str, path: str, headers: dict,
+            body: bytes, timeout: float = FORWARD_TIMEOUT) -> tuple:
+        """
+        Send a request to the owner of a game. Returns the status, headers
+        and body of its response, or of a 502 or 503 if the owner couldn't
+        be reached or didn't answer in time.
+        """
+        url = self.owner_url(code).rstrip('/') + path
+        headers = {k: v for k, v in headers.items()
+                if k.lower() in ('cookie', 'content-type', 'accept',
+                    'accept-language', 'if-none-match')}
+        request = urllib.request.Request(url, data=body or None,
+                headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status, response.getheaders(), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.items(), e.read()
+        except OSError as e:
+            # URLError wraps the errors of connecting, reading raises them
+            reason = getattr(e, 'reason', e)
+            eprint(f'Forwarding to {url} failed: {reason}')
+            if isinstance(reason, socket.timeout):
+                return _error(503, f'Owner of game {code} timed out',
+                        [('Retry-After', '1')])
+            return _error(502, f'Owner of game {code} is unreachable')
+
+
+def _error(status: int, message: str, headers: list = ()) -> tuple:
+    return status, [('Content-Type', 'application/json'), *headers], \
+            encoding.dumps({'message': message})
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _forget(code: str) -> None:
+    import gamedb
+    with gamedb.lock(code):
+        gamedb.cache.discard(code)
+
+
+cluster = Cluster()
+
+
+def configure(node: str, nodes: dict, fanout=None) -> None:
+    global cluster
+    import gamedb
+    cluster = Cluster(node, nodes)
+    # Other workers read games from the database, so every change has to
+    # reach it immediately
+    gamedb.configure(flush_policy='sync')
+    if fanout is not None:
+        # Games changed by another worker must be reloaded
+        gamedb.hub.on_remote(_forget)
+        gamedb.hub.attach(fanout)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from hashlib import blake2b
+from threading import Lock
+
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+LENGTH = 6
+
+# Codes are a permutation of the counter values. The permutation is a
+# Feistel network over pairs of three letter halves, using addition modulo
+# the size of a half so it maps the code space exactly onto itself.
+_HALF = len(ALPHABET) ** (LENGTH // 2)
+SPACE = _HALF * _HALF
+_ROUNDS = 4
+
+
+def permute(index: int, key: bytes) -> int:
+    left, right = divmod(index, _HALF)
+    for i in range(_ROUNDS):
+        digest = blake2b(right.to_bytes(4, 'little') + bytes((i,)), key=key,
+                digest_size=8).digest()
+        left, right = right, (left + int.from_bytes(digest, 'little')) % _HALF
+    return left * _HALF + right
+
+
+def encode(number: int) -> str:
+    letters = []
+    for _ in range(LENGTH):
+        number, digit = divmod(number, len(ALPHABET))
+        letters.append(ALPHABET[digit])
+    return ''.join(reversed(letters))
+
+
+class CodeAllocator:
+    """
+    Hands out unique game codes by permuting a counter. Counter values are
+    reserved from the database in blocks, so codes are unique across
+    processes and allocating one normally doesn't touch the database.
+    """
+
+    def __init__(self, reserve, block_size: int = 64):
+        """
+        reserve(count) must atomically reserve count counter values and
+        return the first one together with the permutation key.
+        """
+        self.reserve = reserve
+        self.block_size = block_size
+        self._mutex = Lock()
+        self._next = 0
+        self._end = 0
+        self._key = None
+
+
+    def allocate(self) -> str:
+        with self._mutex:
+            if self._next == self._end:
+                self._next, self._key = self.reserve(self.block_size)
+                self._end = self._next + self.block_size
+            if self._next >= SPACE:
+                raise RuntimeError('All game codes are in use')
+            index = self._next
+            self._next += 1
+            return encode(permute(index, self._key))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Compact JSON encoding for responses, stream frames and game states.
+
+Uses orjson when it is installed and the json module otherwise. Parts that
+change rarely can be encoded once as a Fragment and embedded as is.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_encoder = json.JSONEncoder(separators=(',',':'), ensure_ascii=False)
+
+
+class Fragment:
+    """
+    Already encoded JSON value.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return _encoder.encode(value).encode('utf-8')
+
+
+def fragment(value) -> Fragment:
+    return Fragment(dumps(value))
+
+
+def dumps_object(fields: dict) -> bytes:
+    """
+    Encode a dict whose values may be Fragments.
+    """
+    return b'{' + b','.join(dumps(k) + b':' +
+            (v.data if type(v) == Fragment else dumps(v))
+            for k, v in fields.items()) + b'}'
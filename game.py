@@ -1,205 +1,542 @@
 import random
 import json
+import encoding
+import struct
+import sys
+from array import array
 
 
 class GameException(Exception):
     pass
 
 
+class Side:
+    """
+    Players winning together. A side wins once it is the only one with
+    living players, or with parity, once it has at least as many living
+    players as all other sides.
+    """
+
+    def __init__(self, name: str, parity: bool = False):
+        self.name = name
+        self.parity = parity
+
+
+class Role:
+    """
+    Role of a player, playing for a side. When the game starts, count
+    players are dealt the role. Everyone else keeps the first role.
+    """
+
+    def __init__(self, name: str, side: str, count: int = 0):
+        self.name = name
+        self.side = side
+        self.count = count
+
+
+class Phase:
+    """
+    Activity in which players vote on someone to kill. Only living players
+    with the voters role take part, or all living players if it is None.
+    Unanimous phases only resolve when all voters agree. After duration
+    seconds the phase may be ended by gamedb.PhaseTimers.
+    """
+
+    def __init__(self, name: str, voters: int = None, unanimous: bool = False,
+            duration: float = None):
+        self.name = name
+        self.voters = voters
+        self.unanimous = unanimous
+        self.duration = duration
+
+
+ROLE_CITIZEN = 0
+ROLE_WOLF = 1
+
+# The sides, roles and the phases of a round, in order. Game compiles these
+# into its dispatch tables at import. Sides, roles and activities are stored
+# by index, so new ones are appended. Sides are checked for a winner in
+# order.
+SIDES = (
+        Side('citizens'),
+        Side('wolves', parity=True),
+    )
+ROLES = (
+        Role('citizen', 'citizens'),
+        Role('wolf', 'wolves', count=1),
+    )
+PHASES = (
+        Phase('wolves', voters=ROLE_WOLF, unanimous=True, duration=120),
+        Phase('vote', duration=300),
+    )
+
+ROLE_NAMES = tuple(r.name for r in ROLES)
+
+NO_VOTE = -1
+
+ACTIVITIES = ('waiting', 'wolves', 'vote', 'finished')
+ACTIVITIES += tuple(p.name for p in PHASES if p.name not in ACTIVITIES)
+WINNERS = (None,) + tuple(s.name for s in SIDES)
+
+# Binary state layout, all integers little endian:
+#
+#   header      magic, format version, activity, winners, player count
+#   version     uint32, number of events applied to the game (format 2+)
+#   lengths     uint16 per player, length of the UTF-8 encoded name
+#   names       concatenated UTF-8 encoded names
+#   roles       uint8 per player
+#   alive       uint8 per player
+#   voted_for   int16 per player, NO_VOTE if the player hasn't voted
+BINARY_MAGIC = b'WWG'
+BINARY_VERSION = 2
+_BINARY_HEADER = struct.Struct('<3sBBBH')
+_BINARY_GAME_VERSION = struct.Struct('<I')
+
+# Limits of the binary layout. Players are ids in the int16 votes, names
+# are counted in uint16 lengths.
+MAX_PLAYERS = 0x7fff
+MAX_NAME_BYTES = 0xffff
+
+
 class Game:
 
-    def __init__(self, serialized_data: dict = None):
-        self._activity_order = (
-            'wolves',
-            'vote',
+    # Players are interned to integer ids in join order. Roles, alive flags
+    # and the votes of the current activity are stored in arrays indexed by
+    # those ids.
+    #
+    # The number of living players per role and the ballot tallies are kept
+    # up to date as votes and deaths happen, so resolving an activity never
+    # has to look at the whole roster. _vote_levels[k] holds the ids of the
+    # players with exactly k votes, for k > 0.
+    __slots__ = (
+            '_names',
+            '_ids',
+            '_roles',
+            '_alive',
+            '_voted_for',
+            '_votes',
+            '_votes_cast',
+            '_vote_levels',
+            '_max_votes',
+            '_alive_roles',
+            '_winners',
+            '_events',
+            '_options',
+            'activity',
+            'version',
         )
-        self._activity_actions = {
-            'vote': self._action_vote,
-            'wolves': self._action_wolves,
-        }
-        self._activity_info = {
-            'waiting': lambda _: {},
-            'finished': self._info_finished,
-            'vote': self._info_vote,
-            'wolves': self._info_wolves,
-        }
+
+    # Dispatch tables compiled from PHASES and ROLES
+    _PHASES = {p.name: p for p in PHASES}
+    _NEXT_PHASE = {p.name: PHASES[(i + 1) % len(PHASES)].name
+            for i, p in enumerate(PHASES)}
+    _SIDE_ROLES = {s.name: tuple(i for i, r in enumerate(ROLES) if r.side == s.name)
+            for s in SIDES}
+    _DEALT_ROLES = tuple(i for i, r in enumerate(ROLES) for _ in range(r.count))
+
+    def __init__(self, serialized_data: dict = None):
+        self._names = []
+        self._ids = {}
+        self._roles = array('b')
+        self._alive = bytearray()
+        self._alive_roles = array('I', (0,)) * len(ROLES)
+        self._winners = None
+        self._events = []
+        self._options = None
+        self.activity = 'waiting'
+        self.version = 0
         if serialized_data is None:
-            self.player_roles = {}
-            self.dead_players = set()
-            self.activity = 'waiting'
-            self._activity_state = {}
+            self._reset_votes()
+        elif serialized_data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            self._load_binary(serialized_data)
         else:
-            data = json.loads(serialized_data)
-            self.player_roles = data['players']
-            self.dead_players = set(data['dead'])
-            self.activity = data['activity']
-            self._activity_state = data['state']
+            self._load_json(serialized_data)
+
+
+    @property
+    def player_roles(self) -> dict:
+        return {n: ROLE_NAMES[r] for n, r in zip(self._names, self._roles)}
+
+
+    @property
+    def player_count(self) -> int:
+        return len(self._names)
+
+
+    @property
+    def dead_players(self) -> set:
+        return {n for n, a in zip(self._names, self._alive) if not a}
 
 
     def add_player(self, name: str):
         name = name.strip()
-        if name in self.player_roles:
+        if name in self._ids:
             raise GameException(f'Name {name} has already been taken')
-        self.player_roles[name] = 'citizen'
-
-
-    def start(self):
-        if len(self.player_roles) < 4:
-            raise GameException('You need at least 4 players to start a game')
-        wolf = random.choice(list(self.player_roles))
-        self.player_roles[wolf] = 'wolf'
-        self.activity = self._activity_order[0]
+        if len(name.encode('utf-8')) > MAX_NAME_BYTES:
+            raise GameException('Name is too long')
+        if len(self._names) >= MAX_PLAYERS:
+            raise GameException('Game is full')
+        self._intern(name, ROLE_CITIZEN)
+        self._record('join', name)
+
+
+    def start(self, *dealt: str):
+        """
+        Deal the roles with a count to the given players in the order of
+        ROLES, or to random players if none are given.
+        """
+        roles = self._DEALT_ROLES
+        minimum = max(4, len(roles))
+        if len(self._names) < minimum:
+            raise GameException(f'You need at least {minimum} players to start a game')
+        if len(dealt) == 0:
+            dealt = random.sample(self._names, len(roles))
+        elif len(dealt) != len(roles):
+            raise GameException(f'Expected {len(roles)} players to deal roles to')
+        elif len(set(dealt)) != len(dealt):
+            raise GameException('A player can only be dealt one role')
+        for name in dealt:
+            self._check_exists(name)
+        self._record('start', *dealt)
+        for name, role in zip(dealt, roles):
+            id = self._ids[name]
+            self._alive_roles[self._roles[id]] -= 1
+            self._roles[id] = role
+            self._alive_roles[role] += 1
+        self.activity = PHASES[0].name
+        self._reset_votes()
 
 
     def perform_action(self, player: str, action: dict):
         self._check_not_finished()
         if self.activity == 'waiting':
-            return GameError('Game has not started yet')
-        return self._activity_actions[self.activity](player, action)
+            raise GameException('Game has not started yet')
+        result = self._action_ballot(self._PHASES[self.activity], player, action)
+        self._record('action', player, {k: action.get(k) for k in action})
+        return result
+
+
+    def perform_actions(self, actions) -> list:
+        """
+        Perform (player, action) pairs in order. Returns the result of each
+        action, or the GameException it raised. A failed action doesn't stop
+        the ones after it, just like separate perform_action calls.
+        """
+        results = []
+        for player, action in actions:
+            try:
+                results.append(self.perform_action(player, action))
+            except GameException as e:
+                results.append(e)
+        return results
+
+
+    def expire_activity(self):
+        """
+        End the current activity because its time ran out. The player with
+        the most votes dies, unless nobody voted or there's a tie.
+        """
+        self._check_not_finished()
+        if self.activity == 'waiting':
+            raise GameException('Game has not started yet')
+        leaders = self._vote_levels[self._max_votes]
+        if self._max_votes > 0 and len(leaders) == 1:
+            self._kill(next(iter(leaders)))
+        self._next_activity()
+        self._record('timeout')
+
+
+    def apply_event(self, event: list):
+        """
+        Replay an event as returned by drain_events().
+        """
+        kind, *args = event
+        if kind == 'join':
+            self.add_player(*args)
+        elif kind == 'start':
+            self.start(*args)
+        elif kind == 'action':
+            self.perform_action(*args)
+        elif kind == 'timeout':
+            self.expire_activity()
+        else:
+            raise GameException(f'Unknown event {kind}')
+
+
+    def drain_events(self) -> list:
+        """
+        Return the events recorded since the last call as (version, event)
+        pairs, oldest first.
+        """
+        events = self._events
+        self._events = []
+        return events
 
 
     def get_info(self, player: str):
-        return self._activity_info[self.activity](player)
+        phase = self._PHASES.get(self.activity)
+        if phase is not None:
+            return self._info_ballot(phase, player)
+        if self.activity == 'finished':
+            return {'winners': self._winners}
+        return {}
 
 
-    def serialize(self):
-        return json.dumps({
+    def view_class(self, player: str):
+        """
+        Players of the same class get the same info from get_info. Returns
+        None for a player that hasn't joined.
+        """
+        id = self._ids.get(player)
+        if id is None:
+            return None
+        if self.activity == 'waiting':
+            # Nobody has voted yet, the ballot isn't even allocated
+            return (self._roles[id], self._alive[id], NO_VOTE)
+        return (self._roles[id], self._alive[id], self._voted_for[id])
+
+
+    def serialize(self, format: str = 'json'):
+        """
+        Serialize the game as either 'json' or the compact 'binary' format.
+        Both are accepted by the constructor.
+        """
+        if format == 'binary':
+            return self._serialize_binary()
+        if format != 'json':
+            raise ValueError(f'Unknown serialization format {format}')
+        if self._winners is not None:
+            state = {'winners': self._winners}
+        elif self._votes_cast > 0:
+            state = {
+                    'voted_for': self._voted_for_dict(),
+                    'votes': self._vote_count_dict(),
+                }
+        else:
+            state = {}
+        return encoding.dumps({
                 'players': self.player_roles,
-                'dead': list(self.dead_players),
+                'dead': [n for n, a in zip(self._names, self._alive) if not a],
                 'activity': self.activity,
-                'state': self._activity_state,
-            }, separators=(',',':'))
+                'state': state,
+                'version': self.version,
+            }).decode('utf-8')
+
+
+    def _serialize_binary(self):
+        names = [n.encode('utf-8') for n in self._names]
+        if len(names) > MAX_PLAYERS or any(len(n) > MAX_NAME_BYTES for n in names):
+            # Joined before add_player checked the limits, JSON has none
+            return self.serialize('json')
+        lengths = array('H', (len(n) for n in names))
+        voted_for = array('h', self._voted_for)
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            voted_for.byteswap()
+        return b''.join((
+                _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                        ACTIVITIES.index(self.activity),
+                        WINNERS.index(self._winners), len(names)),
+                _BINARY_GAME_VERSION.pack(self.version),
+                lengths.tobytes(),
+                *names,
+                self._roles.tobytes(),
+                bytes(self._alive),
+                voted_for.tobytes(),
+            ))
+
+
+    def _load_json(self, serialized_data):
+        data = json.loads(serialized_data)
+        for name, role in data['players'].items():
+            self._intern(name, ROLE_NAMES.index(role))
+        for name in data['dead']:
+            self._kill(self._ids[name])
+        self.activity = data['activity']
+        self._reset_votes()
+        state = data['state']
+        for voter, target in state.get('voted_for', {}).items():
+            self._cast_vote(self._ids[voter], self._ids[target])
+        self._winners = state.get('winners')
+        self.version = data.get('version', 0)
+
+
+    def _load_binary(self, serialized_data: bytes):
+        _, version, activity, winners, count = \
+                _BINARY_HEADER.unpack_from(serialized_data)
+        if version not in (1, BINARY_VERSION):
+            raise GameException(f'Unsupported state format version {version}')
+        offset = _BINARY_HEADER.size
+        if version >= 2:
+            self.version, = _BINARY_GAME_VERSION.unpack_from(serialized_data, offset)
+            offset += _BINARY_GAME_VERSION.size
+        lengths = array('H', serialized_data[offset:offset + 2 * count])
+        offset += 2 * count
+        names = []
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        for length in lengths:
+            names.append(serialized_data[offset:offset + length].decode('utf-8'))
+            offset += length
+        roles = serialized_data[offset:offset + count]
+        alive = serialized_data[offset + count:offset + 2 * count]
+        offset += 2 * count
+        voted_for = array('h', serialized_data[offset:offset + 2 * count])
+        if sys.byteorder == 'big':
+            voted_for.byteswap()
+        for id, name in enumerate(names):
+            self._intern(name, roles[id])
+            if not alive[id]:
+                self._kill(id)
+        self.activity = ACTIVITIES[activity]
+        self._reset_votes()
+        for voter, target in enumerate(voted_for):
+            if target != NO_VOTE:
+                self._cast_vote(voter, target)
+        self._winners = WINNERS[winners]
+
+
+    def _record(self, *event):
+        self.version += 1
+        self._events.append((self.version, event))
+
+
+    def _intern(self, name: str, role: int):
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+        self._roles.append(role)
+        self._alive.append(1)
+        self._alive_roles[role] += 1
+        if self.activity != 'waiting':
+            self._voted_for.append(NO_VOTE)
+            self._votes.append(0)
+
+
+    def _kill(self, id: int):
+        self._alive[id] = 0
+        self._alive_roles[self._roles[id]] -= 1
+
+
+    def _reset_votes(self):
+        count = len(self._names)
+        self._voted_for = array('i', (NO_VOTE,)) * count
+        self._votes = array('I', (0,)) * count
+        self._votes_cast = 0
+        self._vote_levels = [set()]
+        self._max_votes = 0
+
+
+    def _cast_vote(self, voter: int, target: int):
+        levels = self._vote_levels
+        previous = self._voted_for[voter]
+        if previous == NO_VOTE:
+            self._votes_cast += 1
+        else:
+            count = self._votes[previous]
+            levels[count].discard(previous)
+            if count > 1:
+                levels[count - 1].add(previous)
+            if count == self._max_votes and len(levels[count]) == 0:
+                self._max_votes -= 1
+            self._votes[previous] = count - 1
+        self._voted_for[voter] = target
+        count = self._votes[target] + 1
+        if count > 1:
+            levels[count - 1].discard(target)
+        if count == len(levels):
+            levels.append(set())
+        levels[count].add(target)
+        self._max_votes = max(self._max_votes, count)
+        self._votes[target] = count
 
 
     def _next_activity(self):
-        self._activity_state = {}
-
-        if self.activity == 'vote':
-            if self._is_finished():
-                self.activity = 'finished'
-                return
-
-        assert self.activity != 'waiting'
-        assert self.activity != 'finished'
-
-        index = self._activity_order.index(self.activity)
-        index += 1
-        index %= len(self._activity_order)
-        self.activity = self._activity_order[index]
-
-        if self.activity == 'vote':
-            if self._is_finished():
-                self.activity = 'finished'
+        self._reset_votes()
+        if self._is_finished():
+            self.activity = 'finished'
+        else:
+            self.activity = self._NEXT_PHASE[self.activity]
 
 
-    def _action_vote(self, player: str, action: dict):
-        self._check_activity('vote')
+    def _action_ballot(self, phase: Phase, player: str, action: dict):
+        self._check_exists(player)
         self._check_alive(player)
+        role = self._roles[self._ids[player]]
+        if phase.voters is not None and role != phase.voters:
+            raise GameException(f'Player {player} is not a {ROLE_NAMES[phase.voters]}')
         user = Game._get_action_value(action, 'player', str)
         self._check_exists(user)
         self._check_alive(user)
 
-        state = self._activity_state
-        voted_for = state.setdefault('voted_for', {}).get(player)
-        if voted_for is not None:
-            state['votes'][voted_for] -= 1
-        state['voted_for'][player] = user
-        state.setdefault('votes', {}).setdefault(user, 0)
-        state['votes'][user] += 1
-
-        if len(state['voted_for']) == len(self.player_roles) - len(self.dead_players):
-            max_votes = max(state['votes'].values())
-            players = [p for p in state['votes'] if state['votes'][p] == max_votes]
-            if len(players) == 1:
-                self.dead_players.add(players[0])
-                self._next_activity()
-
+        self._cast_vote(self._ids[player], self._ids[user])
 
-    def _action_wolves(self, player: str, action: dict):
-        self._check_activity('wolves')
-        self._check_alive(player)
-        if self.player_roles[player] != 'wolf':
-            raise GameException(f'Player {player} is not a wolf')
-        user = Game._get_action_value(action, 'player', str)
-        self._check_exists(user)
-        self._check_alive(user)
-
-        state = self._activity_state
-        voted_for = state.setdefault('voted_for', {}).get(player)
-        if voted_for is not None:
-            state['votes'][voted_for] -= 1
-        state['voted_for'][player] = user
-        state.setdefault('votes', {}).setdefault(user, 0)
-        state['votes'][user] += 1
-
-        wolf_count = len([p for p in self.player_roles if p not in self.dead_players and self.player_roles[p] == 'wolf'])
-        if len(state['voted_for']) == wolf_count:
-            players = [p for p, v in state['votes'].items() if v > 0]
-            if len(players) == 1:
-                self.dead_players.add(players[0])
+        if phase.voters is None:
+            voters = sum(self._alive_roles)
+        else:
+            voters = self._alive_roles[phase.voters]
+        if self._votes_cast == voters:
+            leaders = self._vote_levels[self._max_votes]
+            if len(leaders) == 1 and \
+                    (not phase.unanimous or self._max_votes == self._votes_cast):
+                self._kill(next(iter(leaders)))
                 self._next_activity()
 
 
-    def _info_vote(self, player: str):
-        self._check_activity('vote')
-        state = self._activity_state
+    def _info_ballot(self, phase: Phase, player: str):
+        id = self._ids.get(player)
+        if phase.voters is not None and \
+                (id is None or self._roles[id] != phase.voters):
+            return {}
+        vote = NO_VOTE if id is None else self._voted_for[id]
         return {
-                'vote': state.get('voted_for', {}).get(player),
-                'vote_count': state.get('votes', {}),
-                'options': [] if player in self.dead_players else
-                        [p for p in self.player_roles if p not in self.dead_players]
+                'vote': None if vote == NO_VOTE else self._names[vote],
+                'vote_count': self._vote_count_dict(),
+                'options': [] if id is not None and not self._alive[id] else
+                        self._alive_names()
             }
 
 
-    def _info_wolves(self, player: str):
-        self._check_activity('wolves')
-        state = self._activity_state
-        if self.player_roles[player] == 'wolf':
-            return {
-                    'vote': state.get('voted_for', {}).get(player),
-                    'vote_count': state.get('votes', {}),
-                    'options': [] if player in self.dead_players else
-                            [p for p in self.player_roles if p not in self.dead_players]
-                }
-        return {}
+    def _alive_names(self):
+        # Shared by the info of every player until the next event
+        if self._options is None or self._options[0] != self.version:
+            self._options = (self.version,
+                    [n for n, a in zip(self._names, self._alive) if a])
+        return self._options[1]
 
 
-    def _info_finished(self, player: str):
-        self._check_activity('finished')
-        return {
-                'winners': self._activity_state['winners']
-            }
+    def _voted_for_dict(self):
+        names = self._names
+        return {names[i]: names[v] for i, v in enumerate(self._voted_for)
+                if v != NO_VOTE}
+
+
+    def _vote_count_dict(self):
+        names = self._names
+        return {names[i]: v for i, v in enumerate(self._votes) if v > 0}
 
 
     def _is_finished(self):
-        wolf_count = 0
-        citizen_count = 0
-        for player in (p for p in self.player_roles if p not in self.dead_players):
-            if self.player_roles[player] == 'wolf':
-                wolf_count += 1
-            else:
-                citizen_count += 1
-        if wolf_count == 0:
-            self._activity_state['winners'] = 'citizens'
-            return True
-        elif wolf_count >= citizen_count:
-            self._activity_state['winners'] = 'wolves'
-            return True
+        total = sum(self._alive_roles)
+        for side in SIDES:
+            alive = self._alive_side(side.name)
+            if alive == total or (side.parity and alive >= total - alive):
+                self._winners = side.name
+                return True
         return False
 
 
-    def _check_activity(self, name: str):
-        if self.activity != name:
-            raise GameException(f'Current activity is {self.activity}, not {name}')
+    def _alive_side(self, side: str) -> int:
+        return sum(self._alive_roles[r] for r in self._SIDE_ROLES[side])
 
 
     def _check_alive(self, name: str):
-        if name in self.dead_players:
+        id = self._ids.get(name)
+        if id is not None and not self._alive[id]:
             raise GameException(f'Player {name} is dead')
 
 
     def _check_exists(self, name: str):
-        if name not in self.player_roles:
+        if name not in self._ids:
             raise GameException(f'Player {name} does not exist')
 
 
@@ -215,3 +552,142 @@ class Game:
         if type(value) != p_type:
             raise GameException(f'{key} value is not a {p_type}')
         return value
+
+
+class GameView:
+    """
+    Read-only view of a serialized game, with the same info methods as Game.
+
+    Only the header is decoded up front. The roster and votes are decoded
+    on first use, without building the tallies and dispatch tables a Game
+    needs to be modified.
+    """
+
+    __slots__ = (
+            '_data',
+            '_names',
+            '_ids',
+            '_roles',
+            '_alive',
+            '_voted_for',
+            '_count',
+            '_offset',
+            '_winners',
+            'activity',
+            'version',
+        )
+
+    def __init__(self, serialized_data):
+        self._data = serialized_data
+        self._names = None
+        self._ids = None
+        if serialized_data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            _, format, activity, winners, self._count = \
+                    _BINARY_HEADER.unpack_from(serialized_data)
+            if format not in (1, BINARY_VERSION):
+                raise GameException(f'Unsupported state format version {format}')
+            self._offset = _BINARY_HEADER.size
+            self.version = 0
+            if format >= 2:
+                self.version, = _BINARY_GAME_VERSION.unpack_from(serialized_data,
+                        self._offset)
+                self._offset += _BINARY_GAME_VERSION.size
+            self.activity = ACTIVITIES[activity]
+            self._winners = WINNERS[winners]
+        else:
+            self._load_json(serialized_data)
+
+
+    @property
+    def player_roles(self) -> dict:
+        self._decode()
+        return {n: ROLE_NAMES[r] for n, r in zip(self._names, self._roles)}
+
+
+    @property
+    def player_count(self) -> int:
+        return self._count
+
+
+    @property
+    def dead_players(self) -> set:
+        self._decode()
+        return {n for n, a in zip(self._names, self._alive) if not a}
+
+
+    def get_info(self, player: str):
+        if self.activity == 'waiting':
+            return {}
+        if self.activity == 'finished':
+            return {'winners': self._winners}
+        self._decode()
+        phase = Game._PHASES[self.activity]
+        id = self._ids.get(player)
+        if phase.voters is not None and \
+                (id is None or self._roles[id] != phase.voters):
+            return {}
+        vote = NO_VOTE if id is None else self._voted_for[id]
+        votes = [0] * self._count
+        for target in self._voted_for:
+            if target != NO_VOTE:
+                votes[target] += 1
+        names = self._names
+        return {
+                'vote': None if vote == NO_VOTE else names[vote],
+                'vote_count': {names[i]: v for i, v in enumerate(votes) if v > 0},
+                'options': [] if id is not None and not self._alive[id] else
+                        [n for n, a in zip(names, self._alive) if a]
+            }
+
+
+    def view_class(self, player: str):
+        self._decode()
+        id = self._ids.get(player)
+        if id is None:
+            return None
+        if self.activity == 'waiting':
+            # Nobody has voted yet, the ballot isn't even allocated
+            return (self._roles[id], self._alive[id], NO_VOTE)
+        return (self._roles[id], self._alive[id], self._voted_for[id])
+
+
+    def _load_json(self, serialized_data):
+        data = json.loads(serialized_data)
+        self._names = list(data['players'])
+        self._ids = {n: i for i, n in enumerate(self._names)}
+        self._roles = bytes(ROLE_NAMES.index(r) for r in data['players'].values())
+        alive = bytearray(b'\x01') * len(self._names)
+        for name in data['dead']:
+            alive[self._ids[name]] = 0
+        self._alive = alive
+        self._voted_for = [NO_VOTE] * len(self._names)
+        state = data['state']
+        for voter, target in state.get('voted_for', {}).items():
+            self._voted_for[self._ids[voter]] = self._ids[target]
+        self._count = len(self._names)
+        self._winners = state.get('winners')
+        self.activity = data['activity']
+        self.version = data.get('version', 0)
+
+
+    def _decode(self):
+        if self._names is not None:
+            return
+        data, count, offset = self._data, self._count, self._offset
+        lengths = array('H', data[offset:offset + 2 * count])
+        offset += 2 * count
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        names = []
+        for length in lengths:
+            names.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        self._roles = data[offset:offset + count]
+        self._alive = data[offset + count:offset + 2 * count]
+        offset += 2 * count
+        voted_for = array('h', data[offset:offset + 2 * count])
+        if sys.byteorder == 'big':
+            voted_for.byteswap()
+        self._voted_for = voted_for
+        self._ids = {n: i for i, n in enumerate(names)}
+        self._names = names
@@ -1,76 +1,1312 @@
 #!/usr/bin/env python3
 
+import atexit
+from admission import Overloaded
+import cluster
+import heapq
+import json
 import sqlite3
-from game import Game
-from threading import Lock
+import stats
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from codes import CodeAllocator
+from game import Game, GameView, PHASES
+from hub import Hub
+from threading import Condition, Event, Lock, Thread, get_ident, local
 
 
 
-class DBLock:
+class TimedCursor(sqlite3.Cursor):
 
-    def __init__(self, cursor):
+    def execute(self, *args):
+        with stats.timer('gamedb_query_seconds'):
+            return super().execute(*args)
+
+
+    def executemany(self, *args):
+        with stats.timer('gamedb_query_seconds'):
+            return super().executemany(*args)
+
+
+class TimedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+class PooledConnection:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def __enter__(self):
+        self.connection = self.pool._acquire()
+        return self.connection.cursor()
+
+
+    def __exit__(self, type, value, traceback):
+        self.pool._release(self.connection)
+
+
+class Transaction(PooledConnection):
+
+    def __init__(self, pool, mode: str):
+        super().__init__(pool)
+        self.mode = mode
+
+
+    def __enter__(self):
+        cursor = super().__enter__()
+        cursor.execute(f'BEGIN {self.mode}')
+        return cursor
+
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.connection.execute('COMMIT' if type is None else 'ROLLBACK')
+        finally:
+            super().__exit__(type, value, traceback)
+
+
+class ConnectionPool:
+    """
+    A bounded pool of SQLite connections in autocommit mode.
+
+    A thread that already holds a connection gets the same one back, so
+    nested helpers can't deadlock on an exhausted pool. Connections still
+    in use when the pool is closed are closed once they are released.
+    """
+
+    def __init__(self, path: str, size: int = 8, busy_timeout: int = 5000):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self._condition = Condition()
+        self._idle = []
+        self._open = 0
+        self._waits = 0
+        self._closed = False
+        self._local = local()
+
+
+    def cursor(self) -> PooledConnection:
+        return PooledConnection(self)
+
+
+    def transaction(self, mode: str = 'IMMEDIATE') -> Transaction:
+        return Transaction(self, mode)
+
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                    'size': self.size,
+                    'open': self._open,
+                    'idle': len(self._idle),
+                    'in_use': self._open - len(self._idle),
+                    'waits': self._waits,
+                }
+
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._open -= len(self._idle)
+            self._idle = []
+
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False,
+                isolation_level=None, factory=TimedConnection)
+        # Only takes effect on a new database, older ones need a VACUUM
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        connection.set_trace_callback(_trace)
+        return connection
+
+
+    def _acquire(self) -> sqlite3.Connection:
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+        with self._condition:
+            if len(self._idle) == 0 and self._open >= self.size:
+                self._waits += 1
+                # A slot also frees up when opening a connection fails
+                self._condition.wait_for(
+                        lambda: len(self._idle) > 0 or self._open < self.size)
+            if len(self._idle) > 0:
+                connection = self._idle.pop()
+            else:
+                self._open += 1
+                connection = None
+        if connection is None:
+            try:
+                connection = self._connect()
+            except:
+                with self._condition:
+                    self._open -= 1
+                    self._condition.notify()
+                raise
+        self._local.held = connection
+        self._local.depth = 1
+        return connection
+
+
+    def _release(self, connection: sqlite3.Connection) -> None:
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.held = None
+        with self._condition:
+            if self._closed:
+                connection.close()
+                self._open -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+
+class CacheEntry:
+
+    def __init__(self, game: Game, state, dirty: bool, snapshot: int = None):
+        self.game = game
+        self.state = state
+        self.dirty = dirty
+        # Activity and player count in the database, None if unknown
+        self.activity = None if dirty else game.activity
+        self.players = None if dirty else game.player_count
+        # Version of the snapshot in the database, None if unknown
+        self.snapshot = snapshot
+
+
+class GameCache:
+    """
+    Keeps live games in memory in front of SQLite, bounded by an LRU.
+
+    With the 'sync' flush policy every save is written through immediately.
+    'phase' delays writes until the game moves to another activity, and
+    'timer' only writes on the flush interval. Dirty games are always
+    written out on eviction and by the periodic flush.
+    """
+
+    POLICIES = ('sync', 'phase', 'timer')
+
+    def __init__(self, size: int = 1024, policy: str = 'sync',
+            interval: float = 5.0):
+        if policy not in GameCache.POLICIES:
+            raise ValueError(f'Unknown flush policy {policy}')
+        self.size = size
+        self.policy = policy
+        self.interval = interval
+        self._mutex = Lock()
+        self._entries = OrderedDict()
+        self._stopped = Event()
+        self._flusher = None
+        if policy != 'sync':
+            self._flusher = Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+
+    def get(self, code: str) -> CacheEntry:
+        with self._mutex:
+            entry = self._entries.get(code)
+            if entry is not None:
+                self._entries.move_to_end(code)
+            return entry
+
+
+    def add(self, code: str, game: Game, state, snapshot: int) -> CacheEntry:
+        """
+        Insert a game that was just read from the database, unless another
+        thread beat us to it.
+        """
+        with self._mutex:
+            entry = self._entries.get(code)
+            if entry is None:
+                entry = self._entries[code] = \
+                        CacheEntry(game, state, False, snapshot)
+            else:
+                self._entries.move_to_end(code)
+        self._evict()
+        return entry
+
+
+    def save(self, code: str, game: Game) -> None:
+        """
+        Record a modified game. The caller must hold the lock of the game.
+        """
+        with self._mutex:
+            entry = self._entries.get(code)
+            if entry is None or entry.game is not game:
+                old = entry
+                entry = self._entries[code] = CacheEntry(game, None, True)
+                if old is not None:
+                    entry.activity, entry.players = old.activity, old.players
+            else:
+                self._entries.move_to_end(code)
+                entry.state = None
+                entry.dirty = True
+        if self.policy == 'sync' or \
+                (self.policy == 'phase' and entry.activity != game.activity):
+            self._write(code, entry)
+        self._evict()
+
+
+    def flush(self) -> None:
+        with self._mutex:
+            dirty = [(c, e) for c, e in self._entries.items() if e.dirty]
+        for code, entry in dirty:
+            with lock(code):
+                if entry.dirty:
+                    self._write(code, entry)
+
+
+    def discard(self, code: str) -> None:
+        """
+        Forget a game without writing it. The caller must hold its lock.
+        """
+        with self._mutex:
+            self._entries.pop(code, None)
+
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+    def _write(self, code: str, entry: CacheEntry) -> None:
+        game = entry.game
+        events = game.drain_events()
+        # Timeouts alone don't make a game active, see Maintenance
+        played = any(e[0] != 'timeout' for _, e in events)
+        try:
+            # The indexed columns only change with a snapshot, so an event
+            # is a single INSERT
+            if entry.snapshot is None or entry.activity != game.activity or \
+                    entry.players != game.player_count or \
+                    game.version - entry.snapshot >= snapshot_interval:
+                if entry.state is None:
+                    entry.state = game.serialize(state_format)
+                _write_snapshot(code, entry.state, game.version, game, played)
+                entry.snapshot = game.version
+            elif len(events) > 0:
+                _write_events(code, events)
+        except Exception:
+            # The drained events are gone, so the cached game is ahead of
+            # the database for good. Drop it, the next load reads what was
+            # actually written.
+            self.discard(code)
+            raise
+        entry.dirty = False
+        entry.activity = game.activity
+        entry.players = game.player_count
+
+
+    def _evict(self) -> None:
+        with self._mutex:
+            excess = len(self._entries) - self.size
+            if excess <= 0:
+                return
+            candidates = list(self._entries.items())
+        for code, entry in candidates:
+            if excess <= 0:
+                break
+            if entry.dirty:
+                # Games in use by another thread are skipped: blocking here
+                # could deadlock against a thread evicting our own game.
+                game_lock = lock(code)
+                if not game_lock.acquire(False):
+                    continue
+                try:
+                    if entry.dirty:
+                        self._write(code, entry)
+                except sqlite3.Error as e:
+                    # Not the fault of the request evicting it, _write
+                    # already dropped the game
+                    print(f'Writing game {code} failed: {e}', file=sys.stderr)
+                    continue
+                finally:
+                    game_lock.release()
+            with self._mutex:
+                if self._entries.get(code) is entry:
+                    del self._entries[code]
+                    excess -= 1
+
+
+    def _flush_loop(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f'Flushing games failed: {e}', file=sys.stderr)
+
+
+class Maintenance:
+    """
+    Background task moving finished and abandoned games out of the games
+    table into games_archive, compressed.
+
+    A finished game is archived once nothing happened to it for
+    finished_ttl seconds, any other game once nobody played it for idle_ttl
+    seconds. Timeouts don't count as playing.
+    """
+
+    def __init__(self, interval: float = 300, finished_ttl: float = 3600,
+            idle_ttl: float = 7 * 24 * 3600, batch_size: int = 500,
+            vacuum_pages: int = 1000):
+        self.interval = interval
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.archived = 0
+        self._stopped = Event()
+        self._thread = None
+
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def run(self) -> int:
+        """
+        Do a single maintenance pass. Returns the number of archived games.
+        """
+        archived = 0
+        while True:
+            codes = self.expired()
+            count = sum(archive_game(code) for code in codes)
+            archived += count
+            if len(codes) < self.batch_size or count == 0:
+                break
+        with cursor() as c:
+            c.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            c.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})')
+            c.fetchall()
+        self.archived += archived
+        return archived
+
+
+    def expired(self) -> list:
+        codes = []
+        with cursor() as c:
+            c.execute('''
+                    SELECT code FROM games
+                    WHERE finished = 1 AND updated_at < datetime('now', ?1)
+                    UNION
+                    SELECT code FROM games
+                    WHERE updated_at < datetime('now', ?2)
+                    AND NOT EXISTS (SELECT 1 FROM game_events e
+                        WHERE e.code = games.code AND e.date >= datetime('now', ?2)
+                        AND e.event != ?3)''',
+                    (f'-{int(self.finished_ttl)} seconds',
+                        f'-{int(self.idle_ttl)} seconds', TIMEOUT_EVENT))
+            for code, in c:
+                if cluster.cluster.owns(code):
+                    codes.append(code)
+                    if len(codes) == self.batch_size:
+                        break
+        return codes
+
+
+    def _loop(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run()
+            except sqlite3.Error as e:
+                print(f'Maintenance failed: {e}', file=sys.stderr)
+
+
+class PhaseTimers:
+    """
+    Ends activities that take longer than their duration in seconds, so a
+    player that doesn't vote can't stall a game.
+
+    The deadlines of all live games are kept in a single heap, served by
+    one thread that expires every game that is due in one batch. Entries of
+    activities that already ended are left in the heap and skipped once they
+    come up. Deadlines are stored in the games table and read back when the
+    timers start. Activities that started while the timers weren't running
+    get their full duration from then on.
+
+    After max_idle timeouts in a row with nothing played in between, the
+    game is left alone until somebody plays again, so abandoned games stop
+    changing and can be archived.
+    """
+
+    # Stored deadline of games left alone after max_idle timeouts
+    IDLE = 0
+
+    def __init__(self, durations: dict = None, max_idle: int = 4):
+        self.durations = DEFAULT_DURATIONS if durations is None else durations
+        self.max_idle = max_idle
+        self.expired = 0
+        self._condition = Condition()
+        self._heap = []
+        # code -> (deadline, activity)
+        self._pending = {}
+        # code -> (timeouts in a row, version after the last one)
+        self._idle = {}
+        self._stopped = False
+        self._thread = None
+
+
+    def start(self) -> None:
+        activities = list(self.durations)
+        with cursor() as c:
+            c.execute(f'''SELECT code, activity, deadline FROM games
+                    WHERE activity IN ({','.join('?' * len(activities))})''',
+                    activities)
+            rows = c.fetchall()
+        now = time.time()
+        with self._condition:
+            for code, activity, deadline in rows:
+                if not cluster.cluster.owns(code) or deadline == self.IDLE:
+                    continue
+                if deadline is None:
+                    # Started before timers were enabled
+                    deadline = now + self.durations[activity]
+                self._pending[code] = (deadline, activity)
+                self._heap.append((deadline, code))
+            heapq.heapify(self._heap)
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def update(self, code: str, game: Game) -> None:
+        """
+        Start the timer of the current activity of a game if it just
+        started. The caller must hold the lock of the game.
+        """
+        if self._thread is None:
+            return
+        duration = self.durations.get(game.activity)
+        with self._condition:
+            idle = self._idle.get(code)
+            if idle is not None and (idle[1] != game.version or duration is None):
+                # Played since the last timeout, or over
+                del self._idle[code]
+                idle = None
+            pending = self._pending.get(code)
+            if pending is not None and pending[1] == game.activity:
+                return
+            if idle is not None and idle[0] >= self.max_idle:
+                if pending is None:
+                    return
+                del self._pending[code]
+                deadline = self.IDLE
+            elif duration is None:
+                if pending is None:
+                    return
+                del self._pending[code]
+                deadline = None
+            else:
+                deadline = time.time() + duration
+                self._pending[code] = (deadline, game.activity)
+                heapq.heappush(self._heap, (deadline, code))
+                if self._heap[0][1] == code:
+                    self._condition.notify()
+        group_commit.submit([
+                ("UPDATE games SET deadline = ? WHERE code = ?", (deadline, code)),
+            ])
+
+
+    def deadline(self, code: str) -> float:
+        with self._condition:
+            pending = self._pending.get(code)
+        return None if pending is None else pending[0]
+
+
+    def discard(self, code: str) -> None:
+        with self._condition:
+            self._pending.pop(code, None)
+            self._idle.pop(code, None)
+
+
+    def expire(self, due: list) -> None:
+        for code, activity in due:
+            with lock(code):
+                game = load_game(code)
+                if game is None:
+                    with self._condition:
+                        if self._pending.get(code, (None, activity))[1] == activity:
+                            self._pending.pop(code, None)
+                    continue
+                if game.activity != activity:
+                    continue
+                with self._condition:
+                    idle = self._idle.get(code)
+                    count = 1 if idle is None or idle[1] != game.version else idle[0] + 1
+                game.expire_activity()
+                with self._condition:
+                    self._idle[code] = (count, game.version)
+                save_game(code, game)
+            self.expired += 1
+
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                due = []
+                while len(due) == 0:
+                    if self._stopped:
+                        return
+                    now = time.time()
+                    heap = self._heap
+                    while len(heap) > 0 and heap[0][0] <= now:
+                        deadline, code = heapq.heappop(heap)
+                        pending = self._pending.get(code)
+                        if pending is not None and pending[0] == deadline:
+                            due.append((code, pending[1]))
+                    if len(due) == 0:
+                        self._condition.wait(heap[0][0] - now if len(heap) > 0 else None)
+            try:
+                self.expire(due)
+            except sqlite3.Error as e:
+                print(f'Expiring activities failed: {e}', file=sys.stderr)
+
+
+class CommitTicket:
+
+    def __init__(self, statements: list):
+        self.statements = statements
+        self.done = False
+        self.failed = False
+
+
+class GroupCommit:
+    """
+    Lets concurrent writers share a transaction. The first writer to arrive
+    commits everything queued up while it waits for the write lock; writers
+    arriving during that commit are picked up by the next one.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._queue = []
+        self._committing = False
+        self.commits = 0
+        self.writes = 0
+
+
+    def submit(self, statements: list) -> None:
+        """
+        Execute a list of (sql, parameters) pairs in a single transaction,
+        possibly together with those of other threads.
+        """
+        ticket = CommitTicket(statements)
+        with self._condition:
+            self._queue.append(ticket)
+            self._condition.wait_for(lambda: ticket.done or not self._committing)
+            if ticket.done and not ticket.failed:
+                return
+            if not ticket.done:
+                self._committing = True
+                batch = self._queue
+                self._queue = []
+        if ticket.failed:
+            # The shared transaction failed, find out if it was us
+            self._commit([ticket])
+            return
+        failed = True
+        try:
+            self._commit(batch)
+            failed = False
+        except Exception:
+            if len(batch) == 1:
+                raise
+        finally:
+            with self._condition:
+                for t in batch:
+                    t.done = True
+                    t.failed = failed
+                self._committing = False
+                self._condition.notify_all()
+        if failed:
+            self._commit([ticket])
+
+
+    def _commit(self, batch: list) -> None:
+        with transaction() as c:
+            for ticket in batch:
+                for statement, parameters in ticket.statements:
+                    c.execute(statement, parameters)
+        with self._condition:
+            self.commits += 1
+            self.writes += len(batch)
+
+
+class LockEntry:
+
+    def __init__(self):
         self.mutex = Lock()
-        self.cursor = cursor
+        self.users = 0
+        # Threads waiting on a bounded lock, readers don't count
+        self.waiting_writers = 0
+        self.owner = None
+        self.changed = False
+
+
+class GameLock:
+
+    def __init__(self, manager, code: str, bounded: bool = False):
+        self.manager = manager
+        self.code = code
+        self.bounded = bounded
+        self.entry = None
 
 
     def __enter__(self):
-        self.mutex.acquire()
-        self.cursor.execute('BEGIN EXCLUSIVE')
+        self.acquire()
+        return self
 
 
     def __exit__(self, type, value, traceback):
-        self.cursor.execute('END')
-        self.mutex.release()
+        self.release()
+
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Bounded locks raise Overloaded instead of waiting if too many threads
+        already wait for the game, or when the wait takes too long.
+        """
+        manager = self.manager
+        self.entry = manager._acquire(self.code, self.bounded)
+        if self.entry is None:
+            stats.increment('admission_rejected_total', kind='lock_queue')
+            raise Overloaded(f'Too many requests for game {self.code}')
+        start = time.perf_counter()
+        if self.bounded:
+            try:
+                acquired = self.entry.mutex.acquire(blocking,
+                        manager.wait_timeout if blocking else -1)
+            finally:
+                manager._stop_waiting(self.entry)
+        else:
+            acquired = self.entry.mutex.acquire(blocking)
+        if blocking:
+            stats.observe('gamedb_lock_wait_seconds', time.perf_counter() - start)
+        if not acquired:
+            manager._release(self.code)
+            self.entry = None
+            if self.bounded and blocking:
+                stats.increment('admission_rejected_total', kind='lock_timeout')
+                raise Overloaded(f'Game {self.code} is busy')
+            return False
+        self.entry.owner = get_ident()
+        self.entry.changed = False
+        return True
+
+
+    def release(self) -> None:
+        changed = self.entry.changed
+        self.entry.owner = None
+        self.entry.mutex.release()
+        self.manager._release(self.code)
+        self.entry = None
+        if changed:
+            hub.publish(self.code)
+
+
+class LockManager:
+    """
+    Hands out one lock per game code. A lock only exists while someone holds
+    or waits for it, so finished games don't leave entries behind.
+
+    Bounded locks, for requests that can be retried, allow at most
+    max_waiting threads to queue for a game and wait_timeout seconds each.
+    """
+
+    def __init__(self, max_waiting: int = 32, wait_timeout: float = 5.0):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._mutex = Lock()
+        self._entries = {}
+
+
+    def __call__(self, code: str) -> GameLock:
+        return GameLock(self, code)
+
+
+    def bounded(self, code: str) -> GameLock:
+        return GameLock(self, code, True)
+
+
+    def owned(self, code: str) -> bool:
+        with self._mutex:
+            entry = self._entries.get(code)
+            return entry is not None and entry.owner == get_ident()
+
+
+    def mark_changed(self, code: str) -> None:
+        with self._mutex:
+            self._entries[code].changed = True
+
+
+    def _acquire(self, code: str, writer: bool = False) -> LockEntry:
+        """
+        Register a user of the lock of a game. Returns None instead for a
+        writer if max_waiting writers already wait for it.
+        """
+        with self._mutex:
+            entry = self._entries.get(code)
+            if entry is None:
+                entry = self._entries[code] = LockEntry()
+            if writer:
+                if entry.waiting_writers >= self.max_waiting:
+                    if entry.users == 0:
+                        del self._entries[code]
+                    return None
+                entry.waiting_writers += 1
+            entry.users += 1
+            return entry
+
+
+    def _stop_waiting(self, entry: LockEntry) -> None:
+        with self._mutex:
+            entry.waiting_writers -= 1
+
+
+    def _release(self, code: str) -> None:
+        with self._mutex:
+            entry = self._entries[code]
+            entry.users -= 1
+            if entry.users == 0:
+                del self._entries[code]
+
+
+pool = ConnectionPool('games.db')
+# Format used when writing games, rows in any format can be read
+state_format = 'binary'
+# Maximum number of events stored after a snapshot before it is rewritten
+snapshot_interval = 32
+# Seconds each activity may take before it is ended by PhaseTimers
+DEFAULT_DURATIONS = {p.name: p.duration for p in PHASES if p.duration is not None}
+lock = LockManager()
+hub = Hub()
+cache = GameCache()
+group_commit = GroupCommit()
+maintenance = Maintenance()
+timers = PhaseTimers()
+# Called with the code of every archived game
+archive_listeners = [lambda code: timers.discard(code)]
+atexit.register(lambda: cache.close())
+
+
+def configure(path: str = None, pool_size: int = None, cache_size: int = None,
+        flush_policy: str = None, flush_interval: float = None,
+        format: str = None, snapshot_every: int = None,
+        lock_queue: int = None, lock_timeout: float = None) -> None:
+    global pool, cache, state_format, snapshot_interval
+    if lock_queue is not None:
+        lock.max_waiting = lock_queue
+    if lock_timeout is not None:
+        lock.wait_timeout = lock_timeout
+    if format is not None:
+        state_format = format
+    if snapshot_every is not None:
+        snapshot_interval = snapshot_every
+    cache.close()
+    cache = GameCache(cache.size if cache_size is None else cache_size,
+            cache.policy if flush_policy is None else flush_policy,
+            cache.interval if flush_interval is None else flush_interval)
+    old = pool
+    pool = ConnectionPool(old.path if path is None else path,
+            old.size if pool_size is None else pool_size, old.busy_timeout)
+    old.close()
+
+
+stats.describe('gamedb_statements_total', 'SQL statements executed')
+stats.describe('gamedb_query_seconds', 'Time spent in cursor execute calls')
+stats.describe('gamedb_lock_wait_seconds', 'Time spent waiting for game locks')
+stats.gauge('gamedb_pool_connections', lambda: pool.stats(), 'state')
+stats.gauge('gamedb_cached_games', lambda: len(cache._entries))
+stats.gauge('gamedb_group_commits', lambda: group_commit.commits)
+stats.gauge('gamedb_group_commit_writes', lambda: group_commit.writes)
+stats.gauge('stream_subscribers', lambda: hub.subscriber_count())
+stats.gauge('games', lambda: count_games(), 'state')
+stats.gauge('games_by_activity', lambda: count_activities(), 'activity')
+stats.gauge('phase_timers_pending', lambda: len(timers._pending))
+stats.gauge('phase_timers_expired', lambda: timers.expired)
+
+
+def _trace(statement: str) -> None:
+    stats.increment('gamedb_statements_total')
+    if __debug__:
+        print(statement)
 
 
-    def locked(self):
-        return self.mutex.locked()
+def start_maintenance(**settings) -> None:
+    """
+    Start archiving games in the background, see Maintenance for settings.
+    """
+    global maintenance
+    maintenance.stop()
+    maintenance = Maintenance(**settings)
+    maintenance.start()
 
 
-connection = sqlite3.connect('games.db', check_same_thread=False)
-cursor = connection.cursor()
-lock = DBLock(cursor)
+def start_timers(durations: dict = None) -> None:
+    """
+    Start ending activities that run out of time, see PhaseTimers.
+    """
+    global timers
+    timers.stop()
+    timers = PhaseTimers(durations)
+    timers.start()
 
-if __debug__:
-    connection.set_trace_callback(print)
+
+def cursor() -> PooledConnection:
+    return pool.cursor()
+
+
+def transaction(mode: str = 'IMMEDIATE') -> Transaction:
+    return pool.transaction(mode)
 
 
 def create_game(code: str) -> None:
-    state = Game().serialize()
-    cursor.execute("INSERT INTO games(code, state) VALUES(?, ?)", (code, state))
-    if not lock.locked():
-        connection.commit()
+    state = Game().serialize(state_format)
+    with cursor() as c:
+        c.execute("INSERT INTO games(code, state, updated_at) VALUES(?, ?, CURRENT_TIMESTAMP)",
+                (code, state))
+
+
+def new_game() -> str:
+    """
+    Create an empty game with a freshly allocated code and return the code.
+    The code is owned by this worker, see cluster.py.
+    """
+    while True:
+        code = allocator.allocate()
+        if not cluster.cluster.owns(code):
+            continue
+        try:
+            create_game(code)
+            stats.increment('games_created_total')
+            return code
+        except sqlite3.IntegrityError:
+            # Taken by a game created before codes were allocated
+            pass
+
+
+def _reserve_codes(count: int) -> tuple:
+    with transaction() as c:
+        c.execute("UPDATE code_allocator SET next = next + ?", (count,))
+        next, key = c.execute("SELECT next, key FROM code_allocator").fetchone()
+    return next - count, key
+
+
+allocator = CodeAllocator(_reserve_codes)
 
 
 def save_game(code: str, game: Game) -> None:
-    state = game.serialize()
-    cursor.execute("UPDATE games SET state = ? WHERE code = ?", (state, code))
-    if not lock.locked():
-        connection.commit()
+    if lock.owned(code):
+        cache.save(code, game)
+        timers.update(code, game)
+        lock.mark_changed(code)
+    else:
+        with lock(code):
+            cache.save(code, game)
+            timers.update(code, game)
+        hub.publish(code)
 
 
 def load_game(code: str) -> Game:
-    cursor.execute("SELECT state FROM games WHERE code = ?", (code,))
-    row = cursor.fetchone()
-    if row is not None:
-        return Game(row[0])
-    return None
+    """
+    Return the live game for the given code. The game is shared with other
+    threads, so hold the lock of the game while reading or modifying it.
+    """
+    entry = _load_entry(code)
+    return None if entry is None else entry.game
+
+
+def load_view(code: str):
+    """
+    Return the game for reading only: the live game if it is cached, else a
+    GameView of the stored state. Hold the lock of the game while reading
+    it, like with load_game.
+    """
+    entry = cache.get(code)
+    if entry is not None:
+        return entry.game
+    with cursor() as c:
+        c.execute('''
+                SELECT state, EXISTS(SELECT 1 FROM game_events e
+                    WHERE e.code = games.code AND e.seq > games.seq)
+                FROM games WHERE code = ?''', (code,))
+        row = c.fetchone()
+    if row is None:
+        return None
+    state, pending = row
+    if pending:
+        # Replaying events needs a live game
+        return load_game(code)
+    return GameView(state)
+
+
+def load_version(code: str) -> int:
+    """
+    Return the version of a game without loading it, or None if it doesn't
+    exist.
+    """
+    entry = cache.get(code)
+    if entry is not None:
+        return entry.game.version
+    with cursor() as c:
+        c.execute('''SELECT max(version, coalesce((SELECT max(seq) FROM game_events
+                WHERE code = ?), 0)) FROM games WHERE code = ?''', (code, code))
+        row = c.fetchone()
+    return None if row is None else row[0]
+
+
+def _load_entry(code: str) -> CacheEntry:
+    entry = cache.get(code)
+    if entry is None:
+        stored = _read_game(code)
+        if stored is None:
+            return None
+        entry = cache.add(code, *stored)
+    return entry
+
+
+def load_session(token: str) -> dict:
+    """
+    Return the names a session plays as, by game code.
+    """
+    with cursor() as c:
+        return dict(c.execute("SELECT code, name FROM session_games WHERE token = ?",
+                (token,)))
+
+
+def load_session_name(token: str, code: str) -> str:
+    with cursor() as c:
+        c.execute("SELECT name FROM session_games WHERE token = ? AND code = ?",
+                (token, code))
+        row = c.fetchone()
+    return None if row is None else row[0]
+
+
+def save_session(token: str, changes: dict) -> None:
+    """
+    Set the names a session plays as by game code, or remove those set to
+    None.
+    """
+    group_commit.submit([
+            ("DELETE FROM session_games WHERE token = ? AND code = ?", (token, code))
+            if name is None else
+            ("INSERT OR REPLACE INTO session_games(token, code, name) VALUES(?, ?, ?)",
+                (token, code, name))
+            for code, name in changes.items()
+        ])
+
+
+def count_games() -> dict:
+    """
+    Count the games in the games table that are still being played or have
+    finished, and the archived games.
+    """
+    counts = {'active': 0, 'finished': 0}
+    with cursor() as c:
+        for finished, count in c.execute(
+                "SELECT finished, count(*) FROM games GROUP BY finished"):
+            counts['finished' if finished else 'active'] = count
+        counts['archived'], = c.execute("SELECT count(*) FROM games_archive").fetchone()
+    return counts
+
+
+def count_activities() -> dict:
+    with cursor() as c:
+        return dict(c.execute(
+                "SELECT activity, count(*) FROM games GROUP BY activity"))
+
+
+def list_games(activity: str = None, limit: int = 100) -> list:
+    """
+    Return the most recently updated games, optionally only those in the
+    given activity, as dicts without the state. Games are ordered by their
+    last snapshot after being played, events since then don't count.
+    """
+    query = "SELECT code, activity, player_count, updated_at FROM games"
+    if activity is not None:
+        query += " WHERE activity = ?"
+    query += " ORDER BY updated_at DESC LIMIT ?"
+    with cursor() as c:
+        rows = c.execute(query, (activity, limit) if activity is not None
+                else (limit,)).fetchall()
+    return [{'code': code, 'activity': activity, 'players': players,
+                'updated_at': updated_at}
+            for code, activity, players, updated_at in rows]
+
+
+def archive_game(code: str) -> bool:
+    """
+    Move a game to the archive. Games in use are skipped, returns whether
+    the game was archived.
+    """
+    game_lock = lock(code)
+    if not game_lock.acquire(False):
+        return False
+    try:
+        game = load_game(code)
+        if game is None:
+            return False
+        state = game.serialize(state_format)
+        if type(state) == str:
+            state = state.encode('utf-8')
+        state = zlib.compress(state)
+        with transaction() as c:
+            c.execute('''INSERT OR REPLACE INTO games_archive(code, state, date)
+                    SELECT code, ?, date FROM games WHERE code = ?''',
+                    (state, code))
+            c.execute("DELETE FROM game_events WHERE code = ?", (code,))
+            c.execute("DELETE FROM session_games WHERE code = ?", (code,))
+            c.execute("DELETE FROM games WHERE code = ?", (code,))
+        cache.discard(code)
+        for listener in archive_listeners:
+            listener(code)
+        # Wake up the streams so they notice the game is gone
+        lock.mark_changed(code)
+        return True
+    finally:
+        game_lock.release()
+
+
+def load_archived_game(code: str) -> Game:
+    with cursor() as c:
+        c.execute("SELECT state FROM games_archive WHERE code = ?", (code,))
+        row = c.fetchone()
+    return None if row is None else Game(zlib.decompress(row[0]))
+
+
+def _read_game(code: str) -> tuple:
+    """
+    Rebuild a game from its latest snapshot and the events stored after it.
+    Returns the game, its serialized state if no events had to be replayed
+    and the version of the snapshot.
+    """
+    with transaction('DEFERRED') as c:
+        c.execute("SELECT state, seq FROM games WHERE code = ?", (code,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        state, seq = row
+        c.execute("SELECT event FROM game_events WHERE code = ? AND seq > ? ORDER BY seq",
+                (code, seq))
+        events = c.fetchall()
+    game = Game(state)
+    for event, in events:
+        game.apply_event(json.loads(event))
+    game.drain_events()
+    return game, state if len(events) == 0 else None, seq
+
+
+def _write_snapshot(code: str, state: str, seq: int, game: Game,
+        played: bool = False) -> None:
+    """
+    Store the state of a game, replacing its events. updated_at is the last
+    time the game was played: now if played, else the latest of the events
+    being replaced that isn't a timeout.
+    """
+    group_commit.submit([
+            ('''UPDATE games SET state = ?, seq = ?, version = ?, activity = ?,
+                    player_count = ?, finished = ?, updated_at =
+                    CASE WHEN ? THEN CURRENT_TIMESTAMP
+                    ELSE max(updated_at, coalesce((SELECT max(date) FROM game_events
+                        WHERE code = games.code AND event != ?), updated_at)) END
+                    WHERE code = ?''',
+                (state, seq, seq, *_columns(game), played, TIMEOUT_EVENT, code)),
+            ("DELETE FROM game_events WHERE code = ? AND seq <= ?",
+                (code, seq)),
+        ])
+
+
+def _write_events(code: str, events: list) -> None:
+    """
+    Append events to the log of a game. The games row is left alone: the
+    version and the last time the game was played are read from the log
+    until the next snapshot.
+    """
+    group_commit.submit([
+            ("INSERT INTO game_events(code, seq, event, date) VALUES(?, ?, ?, CURRENT_TIMESTAMP)",
+                (code, seq, _encode_event(event)))
+            for seq, event in events
+        ])
+
+
+def _encode_event(event) -> str:
+    return json.dumps(event, separators=(',',':'))
+
+
+# Stored form of timeout events, which don't count as playing the game
+TIMEOUT_EVENT = _encode_event(('timeout',))
+
+
+def _columns(game) -> tuple:
+    """
+    Values of the indexed activity, player_count and finished columns.
+    """
+    return game.activity, game.player_count, int(game.activity == 'finished')
+
+
+def migrate_states(format: str = None) -> int:
+    """
+    Rewrite every stored game in the given format, 'binary' by default.
+    Returns the number of rows that were converted.
+    """
+    format = state_format if format is None else format
+    converted = 0
+    with cursor() as c:
+        rows = c.execute("SELECT code, state FROM games").fetchall()
+    for code, state in rows:
+        with lock(code):
+            game, _, seq = _read_game(code)
+            new_state = game.serialize(format)
+            if new_state != state or game.version != seq:
+                _write_snapshot(code, new_state, game.version, game)
+                converted += 1
+    return converted
+
+
+# Each entry upgrades the schema by one version, tracked in user_version
+_MIGRATIONS = (
+    (
+        '''CREATE TABLE IF NOT EXISTS games (
+                code varchar(6) PRIMARY KEY,
+                state text NOT NULL,
+                date datetime DEFAULT CURRENT_TIMESTAMP
+            )''',
+    ),
+    (
+        'ALTER TABLE games ADD COLUMN seq integer NOT NULL DEFAULT 0',
+        '''CREATE TABLE game_events (
+                code varchar(6) NOT NULL,
+                seq integer NOT NULL,
+                event text NOT NULL,
+                PRIMARY KEY (code, seq)
+            ) WITHOUT ROWID''',
+    ),
+    (
+        '''CREATE TABLE code_allocator (
+                next integer NOT NULL,
+                key blob NOT NULL
+            )''',
+        'INSERT INTO code_allocator(next, key) VALUES(0, randomblob(16))',
+    ),
+    (
+        'ALTER TABLE games ADD COLUMN updated_at datetime',
+        'UPDATE games SET updated_at = date',
+        'ALTER TABLE game_events ADD COLUMN date datetime',
+        '''CREATE TABLE games_archive (
+                code varchar(6) PRIMARY KEY,
+                state blob NOT NULL,
+                date datetime,
+                archived_at datetime DEFAULT CURRENT_TIMESTAMP
+            )''',
+    ),
+    (
+        "ALTER TABLE games ADD COLUMN activity text NOT NULL DEFAULT 'waiting'",
+        'ALTER TABLE games ADD COLUMN player_count integer NOT NULL DEFAULT 0',
+        'ALTER TABLE games ADD COLUMN finished integer NOT NULL DEFAULT 0',
+        lambda c: _fill_columns(c),
+        'CREATE INDEX games_activity ON games(activity, updated_at)',
+        'CREATE INDEX games_finished ON games(finished, updated_at)',
+        'CREATE INDEX games_updated_at ON games(updated_at)',
+    ),
+    (
+        'ALTER TABLE games ADD COLUMN version integer NOT NULL DEFAULT 0',
+        '''UPDATE games SET version = max(seq, coalesce((SELECT max(seq)
+                FROM game_events e WHERE e.code = games.code), 0))''',
+    ),
+    (
+        'ALTER TABLE games ADD COLUMN deadline real',
+    ),
+    (
+        '''CREATE TABLE session_games (
+                token text NOT NULL,
+                code varchar(6) NOT NULL,
+                name text NOT NULL,
+                PRIMARY KEY (token, code)
+            ) WITHOUT ROWID''',
+        'CREATE INDEX session_games_code ON session_games(code)',
+    ),
+)
+
+
+def _fill_columns(c: sqlite3.Cursor) -> None:
+    # Older rows only have the state, and events may have been written
+    # after it
+    rows = c.execute('''
+            SELECT code, state, max(updated_at, coalesce((SELECT max(date)
+                FROM game_events e WHERE e.code = games.code), updated_at))
+            FROM games''').fetchall()
+    for code, state, updated_at in rows:
+        events = c.execute('''SELECT event FROM game_events WHERE code = ?
+                AND seq > (SELECT seq FROM games WHERE code = ?) ORDER BY seq''',
+                (code, code)).fetchall()
+        if len(events) == 0:
+            game = GameView(state)
+        else:
+            game = Game(state)
+            for event, in events:
+                game.apply_event(json.loads(event))
+        c.execute('''UPDATE games SET activity = ?, player_count = ?, finished = ?,
+                updated_at = ? WHERE code = ?''',
+                (*_columns(game), updated_at, code))
 
 
-def load_game_raw(code: str) -> Game:
-    cursor.execute("SELECT state FROM games WHERE code = ?", (code,))
-    row = cursor.fetchone()
-    if row is not None:
-        return row[0]
-    return None
+def migrate_schema() -> int:
+    """
+    Bring the database schema up to date. Returns the number of migrations
+    that were applied.
+    """
+    with transaction() as c:
+        version, = c.execute('PRAGMA user_version').fetchone()
+        for statements in _MIGRATIONS[version:]:
+            for statement in statements:
+                if callable(statement):
+                    statement(c)
+                else:
+                    c.execute(statement)
+        if version < len(_MIGRATIONS):
+            c.execute(f'PRAGMA user_version = {len(_MIGRATIONS)}')
+    return max(len(_MIGRATIONS) - version, 0)
 
 
 if __name__ == '__main__':
-    print(f'Creating table games')
-    cursor.execute('''
-            CREATE TABLE games (
-                    code varchar(6) PRIMARY KEY,
-                    state text NOT NULL,
-                    date datetime DEFAULT CURRENT_TIMESTAMP
-                )''')
-    connection.commit()
+    print(f'Applied {migrate_schema()} schema migrations')
+    if sys.argv[1:2] == ['migrate']:
+        format = sys.argv[2] if len(sys.argv) > 2 else state_format
+        print(f'Converting games to {format}')
+        print(f'Converted {migrate_states(format)} games')
+    elif sys.argv[1:2] == ['archive']:
+        print(f'Archived {maintenance.run()} games')
+    elif sys.argv[1:2] == ['list']:
+        activity = sys.argv[2] if len(sys.argv) > 2 else None
+        for g in list_games(activity):
+            print(f"{g['code']}  {g['activity']:8}  {g['players']:3} players  {g['updated_at']}")
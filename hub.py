@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import asyncio
+from threading import Condition, Lock
+
+
+class Channel:
+
+    def __init__(self):
+        self.condition = Condition()
+        self.version = 0
+        self.subscribers = 0
+        self.listeners = []
+
+
+class Subscription:
+
+    def __init__(self, hub, code: str):
+        self.hub = hub
+        self.code = code
+        self.channel = None
+        self.version = 0
+
+
+    def __enter__(self):
+        self.channel = self.hub._acquire(self.code)
+        with self.channel.condition:
+            self.version = self.channel.version
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.hub._release(self.code)
+        self.channel = None
+
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block until a new version of the game is published or the timeout
+        expires. Returns True if the game has changed since the last call.
+        """
+        channel = self.channel
+        with channel.condition:
+            changed = channel.condition.wait_for(
+                    lambda: channel.version != self.version, timeout)
+            self.version = channel.version
+        return changed
+
+
+class AsyncSubscription(Subscription):
+    """
+    Subscription for coroutines. Publishers may run on any thread, they wake
+    the subscriber through its event loop.
+    """
+
+    def __init__(self, hub, code: str, loop: asyncio.AbstractEventLoop):
+        super().__init__(hub, code)
+        self.loop = loop
+        self.event = asyncio.Event()
+
+
+    def __enter__(self):
+        super().__enter__()
+        with self.channel.condition:
+            self.channel.listeners.append(self._notify)
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        with self.channel.condition:
+            self.channel.listeners.remove(self._notify)
+        super().__exit__(type, value, traceback)
+
+
+    async def wait(self, timeout: float = None) -> bool:
+        channel = self.channel
+        self.event.clear()
+        if channel.version == self.version:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        changed = channel.version != self.version
+        self.version = channel.version
+        return changed
+
+
+    def _notify(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class Hub:
+    """
+    In-process publish/subscribe hub keyed by game code.
+
+    Channels only exist while there is at least one subscriber, so publishing
+    to a game nobody is watching is a single dict lookup.
+
+    With a fan-out attached, changes are also shared with the hubs of other
+    processes, see cluster.py.
+    """
+
+    def __init__(self):
+        self._mutex = Lock()
+        self._channels = {}
+        self._fanout = None
+        self._remote_listeners = []
+
+
+    def subscribe(self, code: str) -> Subscription:
+        return Subscription(self, code)
+
+
+    def subscribe_async(self, code: str) -> AsyncSubscription:
+        return AsyncSubscription(self, code, asyncio.get_running_loop())
+
+
+    def attach(self, fanout) -> None:
+        self._fanout = fanout
+        fanout.start(self._receive)
+
+
+    def on_remote(self, listener) -> None:
+        """
+        Call listener(code) before waking up subscribers when another process
+        published a change.
+        """
+        self._remote_listeners.append(listener)
+
+
+    def publish(self, code: str) -> None:
+        self._notify(code)
+        if self._fanout is not None:
+            self._fanout.publish(code)
+
+
+    def _receive(self, code: str) -> None:
+        for listener in self._remote_listeners:
+            listener(code)
+        self._notify(code)
+
+
+    def _notify(self, code: str) -> None:
+        with self._mutex:
+            channel = self._channels.get(code)
+        if channel is not None:
+            with channel.condition:
+                channel.version += 1
+                channel.condition.notify_all()
+                for listener in channel.listeners:
+                    listener()
+
+
+    def subscriber_count(self, code: str = None) -> int:
+        with self._mutex:
+            if code is not None:
+                channel = self._channels.get(code)
+                return 0 if channel is None else channel.subscribers
+            return sum(c.subscribers for c in self._channels.values())
+
+
+    def _acquire(self, code: str) -> Channel:
+        with self._mutex:
+            channel = self._channels.get(code)
+            if channel is None:
+                channel = self._channels[code] = Channel()
+            channel.subscribers += 1
+            return channel
+
+
+    def _release(self, code: str) -> None:
+        with self._mutex:
+            channel = self._channels[code]
+            channel.subscribers -= 1
+            if channel.subscribers == 0:
+                del self._channels[code]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Server-side sessions.
+
+The session maps game codes to the name the browser plays as. Only a random
+token is sent as cookie, the names are kept in a store and read one game at
+a time, so the cost of a request doesn't grow with the number of games a
+browser ever joined. Entries are removed together with their game when it is
+archived, see gamedb.archive_game.
+"""
+
+import secrets
+from collections.abc import MutableMapping
+from flask.sessions import SessionInterface, SessionMixin, \
+        SecureCookieSessionInterface
+from threading import Lock
+import gamedb
+
+
+class ServerSession(SessionMixin, MutableMapping):
+
+    def __init__(self, store, token: str = None):
+        self.store = store
+        self.token = token
+        self.new = token is None
+        self.modified = False
+        self._names = {}
+        self._changes = {}
+        self._complete = False
+
+
+    def __getitem__(self, code: str) -> str:
+        if code not in self._names and not self._complete:
+            self._names[code] = None if self.token is None else \
+                    self.store.get(self.token, code)
+        name = self._names[code] if code in self._names else None
+        if name is None:
+            raise KeyError(code)
+        return name
+
+
+    def __setitem__(self, code: str, name: str) -> None:
+        self._names[code] = self._changes[code] = name
+        self.modified = True
+
+
+    def __delitem__(self, code: str) -> None:
+        self[code]
+        self._names[code] = self._changes[code] = None
+        self.modified = True
+
+
+    @property
+    def permanent(self) -> bool:
+        # The token cookie lasts for the browser session
+        return False
+
+
+    @permanent.setter
+    def permanent(self, value: bool) -> None:
+        pass
+
+
+    def __iter__(self):
+        self._load_all()
+        return iter([c for c, n in self._names.items() if n is not None])
+
+
+    def __len__(self) -> int:
+        self._load_all()
+        return sum(n is not None for n in self._names.values())
+
+
+    def _load_all(self) -> None:
+        if not self._complete:
+            if self.token is not None:
+                names = self.store.all(self.token)
+                names.update(self._changes)
+                self._names = names
+            self._complete = True
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self._mutex = Lock()
+        self._sessions = {}
+        # code -> tokens of the sessions playing it
+        self._members = {}
+
+
+    def get(self, token: str, code: str) -> str:
+        with self._mutex:
+            return self._sessions.get(token, {}).get(code)
+
+
+    def all(self, token: str) -> dict:
+        with self._mutex:
+            return dict(self._sessions.get(token, {}))
+
+
+    def update(self, token: str, changes: dict) -> None:
+        with self._mutex:
+            names = self._sessions.setdefault(token, {})
+            for code, name in changes.items():
+                if name is None:
+                    names.pop(code, None)
+                    self._members.get(code, set()).discard(token)
+                else:
+                    names[code] = name
+                    self._members.setdefault(code, set()).add(token)
+            if len(names) == 0:
+                del self._sessions[token]
+
+
+    def discard_game(self, code: str) -> None:
+        with self._mutex:
+            for token in self._members.pop(code, ()):
+                names = self._sessions[token]
+                del names[code]
+                if len(names) == 0:
+                    del self._sessions[token]
+
+
+class DatabaseStore:
+
+    def get(self, token: str, code: str) -> str:
+        return gamedb.load_session_name(token, code)
+
+
+    def all(self, token: str) -> dict:
+        return gamedb.load_session(token)
+
+
+    def update(self, token: str, changes: dict) -> None:
+        gamedb.save_session(token, changes)
+
+
+    def discard_game(self, code: str) -> None:
+        # gamedb.archive_game already removed them
+        pass
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Session interface keeping the session in a store. Signed cookie
+    sessions of older versions are moved into the store on first use.
+    """
+
+    # Longer values can't be tokens handed out by us
+    MAX_TOKEN_LENGTH = 64
+
+    def __init__(self, store=None):
+        self.store = DatabaseStore() if store is None else store
+        self._legacy = SecureCookieSessionInterface()
+        gamedb.archive_listeners.append(self.store.discard_game)
+
+
+    def open_session(self, app, request) -> ServerSession:
+        value = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if value is None:
+            return ServerSession(self.store)
+        if '.' not in value:
+            if len(value) > self.MAX_TOKEN_LENGTH:
+                return ServerSession(self.store)
+            return ServerSession(self.store, value)
+        session = ServerSession(self.store)
+        serializer = self._legacy.get_signing_serializer(app)
+        try:
+            data = serializer.loads(value)
+        except Exception:
+            return session
+        for code, name in data.items():
+            session[code] = name
+        return session
+
+
+    def save_session(self, app, session: ServerSession, response) -> None:
+        if not session.modified:
+            return
+        if session.token is None:
+            session.token = secrets.token_urlsafe(16)
+        self.store.update(session.token, session._changes)
+        session._changes = {}
+        response.set_cookie(app.config['SESSION_COOKIE_NAME'], session.token,
+                expires=self.get_expiration_time(app, session),
+                domain=self.get_cookie_domain(app),
+                path=self.get_cookie_path(app),
+                secure=self.get_cookie_secure(app),
+                httponly=self.get_cookie_httponly(app),
+                samesite=self.get_cookie_samesite(app))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+
+# Upper bounds in seconds, the last bucket catches everything else
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(BUCKETS, value)
+        with self.mutex:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating within its bucket.
+        """
+        with self.mutex:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c > 0:
+                lower = 0 if i == 0 else BUCKETS[i - 1]
+                upper = BUCKETS[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return BUCKETS[-2]
+
+
+    def to_dict(self) -> dict:
+        return {
+                'count': self.count,
+                'sum': self.sum,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+            }
+
+
+class Timer:
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """
+    Collects counters, histograms and gauges. Gauges are functions called
+    when the stats are read, returning either a number or a dict mapping a
+    label value to a number.
+    """
+
+    def __init__(self):
+        self._mutex = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._mutex:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+
+    def counter(self, name: str, **labels) -> float:
+        with self._mutex:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._mutex:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.histogram(name, **labels).observe(value)
+
+
+    def timer(self, name: str, **labels) -> Timer:
+        return Timer(self.histogram(name, **labels))
+
+
+    def gauge(self, name: str, function, label: str = None) -> None:
+        with self._mutex:
+            self._gauges[name] = (function, label)
+
+
+    def describe(self, name: str, help: str) -> None:
+        self._help[name] = help
+
+
+    def to_dict(self) -> dict:
+        d = {}
+        with self._mutex:
+            counters = list(self._counters.items())
+            histograms = list(self._histograms.items())
+            gauges = list(self._gauges.items())
+        for (name, labels), value in counters:
+            _insert(d, name, labels, value)
+        for (name, labels), histogram in histograms:
+            _insert(d, name, labels, histogram.to_dict())
+        for name, (function, label) in gauges:
+            d[name] = function()
+        return d
+
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._mutex:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda i: i[0])
+            gauges = sorted(self._gauges.items())
+        typed = set()
+        def header(name, type):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {type}')
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            with histogram.mutex:
+                counts = list(histogram.counts)
+                count, sum = histogram.count, histogram.sum
+            cumulative = 0
+            for bound, c in zip(BUCKETS, counts):
+                cumulative += c
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {sum}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for name, (function, label) in gauges:
+            header(name, 'gauge')
+            value = function()
+            if type(value) == dict:
+                for k, v in sorted(value.items()):
+                    lines.append(f'{name}{_format_labels(((label, k),))} {v}')
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _insert(d: dict, name: str, labels: tuple, value) -> None:
+    if len(labels) == 0:
+        d[name] = value
+        return
+    for _, label_value in labels[:-1]:
+        d = d.setdefault(name, {})
+        name = label_value
+    d.setdefault(name, {})[labels[-1][1]] = value
+
+
+registry = Registry()
+increment = registry.increment
+observe = registry.observe
+timer = registry.timer
+gauge = registry.gauge
+describe = registry.describe
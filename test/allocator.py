@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import codes
+
+
+# The permutation doesn't map two counter values onto the same code
+key = b'0123456789abcdef'
+seen = set()
+for i in range(0, codes.SPACE, codes.SPACE // 50000):
+    seen.add(codes.permute(i, key))
+assert len(seen) == len(range(0, codes.SPACE, codes.SPACE // 50000))
+assert all(0 <= n < codes.SPACE for n in seen)
+
+assert codes.encode(0) == 'aaaaaa'
+assert codes.encode(codes.SPACE - 1) == 'zzzzzz'
+
+
+# Blocks are reserved as they run out
+reserved = []
+def reserve(count):
+    start = len(reserved) * count
+    reserved.append(start)
+    return start, key
+
+allocator = codes.CodeAllocator(reserve, 4)
+allocated = [allocator.allocate() for _ in range(10)]
+assert len(set(allocated)) == 10
+assert reserved == [0, 4, 8]
+assert all(len(c) == 6 for c in allocated)
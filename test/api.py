@@ -47,6 +47,47 @@ for n in names:
 
 activity = j['activity']
 
+# Polling with the version as ETag only gets a response once the game changes
+etag = r.headers['ETag']
+r = req.get(f'{BASE_URL}/info/{game_code}/', cookies={'session': sessions[owner]},
+        headers={'If-None-Match': etag})
+assert r.status_code == 304
+r = req.get(f'{BASE_URL}/info/{game_code}/?wait=0.5',
+        cookies={'session': sessions[owner]}, headers={'If-None-Match': etag})
+assert r.status_code == 304
+assert r.headers['ETag'] == etag
+
+# A stream resumed at the current version sends its headers right away,
+# and only sends the info once the game changes
+r = req.get(f'{BASE_URL}/stream/{game_code}/', cookies={'session': sessions[owner]},
+        headers={'Last-Event-ID': etag.strip('"')}, stream=True, timeout=2)
+assert r.status_code == 200
+assert next(r.iter_lines()) == b':'
+r.close()
+
+# A batch of actions is performed for the players of the given sessions
+r = req.post(f'{BASE_URL}/create/', data = {'name': owner},
+        cookies={'session': sessions[owner]})
+assert r.status_code == 201
+batch_code = r.json()['code']
+for n in names:
+    if n != owner:
+        r = req.post(f'{BASE_URL}/join/{batch_code}/', data = {'name': n},
+                cookies={'session': sessions[n]})
+        assert r.status_code == 200
+r = req.post(f'{BASE_URL}/start/{batch_code}/', cookies={'session': sessions[owner]})
+assert r.status_code == 200
+r = req.post(f'{BASE_URL}/actions/{batch_code}/', json=[
+        {'session': sessions[n], 'action': {'player': owner}} for n in names] +
+        [{'session': 'unknown', 'action': {'player': owner}}])
+assert r.status_code == 200
+results = r.json()['results']
+assert len(results) == len(names) + 1
+assert sum(r == {} for r in results) == 1
+assert results[-1] == {'message': 'Name is not set'}
+r = req.post(f'{BASE_URL}/actions/{batch_code}/', json={'player': owner})
+assert r.status_code == 400
+
 # Find out who the wolves are
 assert activity == 'wolves'
 wolves = []
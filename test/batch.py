@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import os
+import sqlite3
+import tempfile
+import time
+from threading import Thread
+import gamedb
+from game import Game, GameException
+
+
+# A failed action doesn't stop the ones after it
+game = Game()
+for n in ('a', 'b', 'c', 'd', 'e'):
+    game.add_player(n)
+game.start('a')
+results = game.perform_actions([
+        ('b', {'player': 'c'}),
+        ('a', {'player': 'x'}),
+        ('a', {}),
+        ('a', {'player': 'b'}),
+    ])
+assert [type(r) for r in results] == [GameException, GameException,
+        GameException, type(None)]
+assert game.activity == 'vote'
+assert game.dead_players == {'b'}
+assert [e[1][0] for e in game.drain_events()] == \
+        ['join'] * 5 + ['start', 'action']
+
+
+gamedb.configure(path=os.path.join(tempfile.mkdtemp(), 'games.db'))
+with gamedb.transaction() as c:
+    c.execute('CREATE TABLE t (x integer PRIMARY KEY)')
+group = gamedb.group_commit
+
+# Writers arriving while another commits share the next transaction
+def submit(x, errors):
+    try:
+        group.submit([('INSERT INTO t VALUES(?)', (x,))])
+    except sqlite3.Error:
+        errors.append(x)
+
+def submit_all(xs):
+    errors = []
+    with group._condition:
+        group._committing = True
+    threads = [Thread(target=submit, args=(x, errors)) for x in xs]
+    for t in threads:
+        t.start()
+    while len(group._queue) < len(xs):
+        time.sleep(0.01)
+    with group._condition:
+        group._committing = False
+        group._condition.notify_all()
+    for t in threads:
+        t.join()
+    return errors
+
+commits = group.commits
+assert submit_all([1, 2, 3]) == []
+assert group.commits == commits + 1
+
+# If the shared transaction fails, each writer retries alone and only the
+# bad one fails
+commits = group.commits
+assert submit_all([4, 1, 5]) == [1]
+assert group.commits == commits + 2
+with gamedb.cursor() as c:
+    assert [x for x, in c.execute('SELECT x FROM t ORDER BY x')] == [1, 2, 3, 4, 5]
+
+# Alone, the error is raised directly
+try:
+    group.submit([('INSERT INTO t VALUES(?)', (1,))])
+    assert False
+except sqlite3.IntegrityError:
+    pass
+
+print('OK')
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+from stats import Registry
+
+
+registry = Registry()
+
+registry.increment('requests_total', endpoint='api.index')
+registry.increment('requests_total', endpoint='api.index')
+assert registry.counter('requests_total', endpoint='api.index') == 2
+assert registry.counter('requests_total', endpoint='api.info') == 0
+
+for i in range(100):
+    registry.observe('request_seconds', 0.001 * i, endpoint='api.index')
+histogram = registry.histogram('request_seconds', endpoint='api.index')
+assert histogram.count == 100
+assert 0.025 <= histogram.quantile(0.5) <= 0.05
+assert 0.05 <= histogram.quantile(0.99) <= 0.1
+
+registry.gauge('games', lambda: {'active': 3, 'finished': 1}, 'state')
+
+d = registry.to_dict()
+assert d['requests_total'] == {'api.index': 2}
+assert d['request_seconds']['api.index']['count'] == 100
+assert d['games'] == {'active': 3, 'finished': 1}
+
+text = registry.to_prometheus()
+assert '# TYPE request_seconds histogram' in text
+assert 'request_seconds_bucket{endpoint="api.index",le="+Inf"} 100' in text
+assert 'requests_total{endpoint="api.index"} 2' in text
+assert 'games{state="active"} 3' in text
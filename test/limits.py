@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import threading
+import time
+from admission import Overloaded, StreamLimits
+from gamedb import LockManager
+
+
+def rejected(function, *args) -> bool:
+    try:
+        function(*args)
+    except Overloaded:
+        return True
+    return False
+
+
+# Streams are limited per game, per client and in total
+limits = StreamLimits(per_game=2, per_client=2, total=3)
+assert StreamLimits().per_client is None
+a = limits.admit('abcdef', '10.0.0.1')
+b = limits.admit('abcdef', '10.0.0.2')
+assert rejected(limits.admit, 'abcdef', '10.0.0.3')
+c = limits.admit('ghijkl', '10.0.0.1')
+assert rejected(limits.admit, 'mnopqr', '10.0.0.4')
+assert rejected(limits.admit, 'ghijkl', '10.0.0.1')
+# Releasing twice frees a single stream
+a.release()
+a.release()
+d = limits.admit('mnopqr', '10.0.0.4')
+assert rejected(limits.admit, 'stuvwx', '10.0.0.5')
+for ticket in (b, c, d):
+    ticket.release()
+assert limits.count() == 0
+assert limits._games == {} and limits._clients == {}
+
+
+# Bounded game locks time out, or fail at once if the queue is full
+lock = LockManager(max_waiting=1, wait_timeout=0.1)
+holder = lock('abcdef')
+holder.acquire()
+assert rejected(lock.bounded('abcdef').acquire)
+lock._acquire('abcdef', True)
+start = time.monotonic()
+assert rejected(lock.bounded('abcdef').acquire)
+assert time.monotonic() - start < 0.1
+lock._stop_waiting(lock._entries['abcdef'])
+lock._release('abcdef')
+
+# Readers waiting for the lock don't fill the queue of writers
+readers = [threading.Thread(target=lambda: lock('abcdef').__enter__().release())
+        for _ in range(40)]
+for reader in readers:
+    reader.start()
+while lock._entries['abcdef'].users < 41:
+    time.sleep(0.01)
+writer = threading.Thread(target=lambda: lock.bounded('abcdef').__enter__().release())
+lock.wait_timeout = 5
+writer.start()
+while lock._entries['abcdef'].waiting_writers == 0:
+    time.sleep(0.01)
+assert rejected(lock.bounded('abcdef').acquire)
+holder.release()
+writer.join()
+for reader in readers:
+    reader.join()
+assert lock._entries == {}
+
+bounded = lock.bounded('abcdef')
+bounded.acquire()
+bounded.release()
+assert lock._entries == {}
+
+print('OK')
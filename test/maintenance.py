@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import json
+import os
+import tempfile
+import gamedb
+from game import Game
+
+
+def play(game, *names):
+    for n in names:
+        game.add_player(n)
+    return game
+
+
+def backdate(code, seconds):
+    with gamedb.cursor() as c:
+        c.execute("UPDATE games SET updated_at = datetime('now', ?) WHERE code = ?",
+                (f'-{seconds} seconds', code))
+
+
+# Migrating a database from before the indexed columns fills them in, also
+# from events written after the snapshot
+gamedb.configure(path=os.path.join(tempfile.mkdtemp(), 'games.db'))
+with gamedb.transaction() as c:
+    for statements in gamedb._MIGRATIONS[:4]:
+        for statement in statements:
+            c.execute(statement)
+    c.execute('PRAGMA user_version = 4')
+    waiting = play(Game(), 'a', 'b')
+    c.execute('''INSERT INTO games(code, state, seq, updated_at)
+            VALUES('waitin', ?, 2, datetime('now', '-1 hour'))''',
+            (waiting.serialize(),))
+    started = play(Game(), 'a', 'b', 'c', 'd')
+    c.execute('''INSERT INTO games(code, state, seq, updated_at)
+            VALUES('starte', ?, 4, datetime('now', '-1 hour'))''',
+            (started.serialize('binary'),))
+    started.drain_events()
+    started.start('a')
+    started.perform_action('a', {'player': 'b'})
+    for seq, event in started.drain_events():
+        c.execute('''INSERT INTO game_events(code, seq, event, date)
+                VALUES('starte', ?, ?, datetime('now', '-1 minute'))''',
+                (seq, json.dumps(event)))
+assert gamedb.migrate_schema() == len(gamedb._MIGRATIONS) - 4
+assert gamedb.migrate_schema() == 0
+with gamedb.cursor() as c:
+    rows = {r[0]: r[1:] for r in c.execute('''SELECT code, activity,
+            player_count, finished, version, updated_at > datetime('now', '-1 hour')
+            FROM games''')}
+assert rows['waitin'] == ('waiting', 2, 0, 2, 0)
+assert rows['starte'] == ('vote', 4, 0, 6, 1)
+assert gamedb.count_activities() == {'waiting': 1, 'vote': 1}
+assert gamedb.load_game('starte').dead_players == {'b'}
+
+
+# Listing and counting read the indexed columns
+gamedb.configure(path=os.path.join(tempfile.mkdtemp(), 'games.db'))
+gamedb.migrate_schema()
+codes = []
+for players in (('a', 'b'), ('a', 'b', 'c', 'd'), ('a', 'b', 'c', 'd')):
+    code = gamedb.new_game()
+    with gamedb.lock(code):
+        game = play(gamedb.load_game(code), *players)
+        if len(players) == 4:
+            game.start('a')
+        gamedb.save_game(code, game)
+    codes.append(code)
+waiting, finished, active = codes
+with gamedb.lock(finished):
+    game = gamedb.load_game(finished)
+    game.perform_action('a', {'player': 'b'})
+    game.perform_action('a', {'player': 'c'})
+    game.perform_action('c', {'player': 'a'})
+    game.perform_action('d', {'player': 'a'})
+    assert game.activity == 'finished'
+    gamedb.save_game(finished, game)
+backdate(waiting, 30)
+backdate(finished, 20)
+backdate(active, 10)
+assert gamedb.count_games() == {'active': 2, 'finished': 1, 'archived': 0}
+assert gamedb.count_activities() == {'waiting': 1, 'finished': 1, 'wolves': 1}
+assert [g['code'] for g in gamedb.list_games()] == [active, finished, waiting]
+assert [(g['code'], g['activity'], g['players']) for g in
+        gamedb.list_games('waiting')] == [(waiting, 'waiting', 2)]
+assert [g['code'] for g in gamedb.list_games(limit=1)] == [active]
+assert gamedb.list_games('vote') == []
+
+
+# Finished games are archived after finished_ttl, others after idle_ttl
+gamedb.save_session('token', {finished: 'a', active: 'a'})
+archived = []
+gamedb.archive_listeners.append(archived.append)
+maintenance = gamedb.Maintenance(finished_ttl=0, idle_ttl=3600)
+assert maintenance.run() == 1
+assert archived == [finished]
+assert gamedb.load_game(finished) is None
+assert gamedb.load_session('token') == {active: 'a'}
+game = gamedb.load_archived_game(finished)
+assert game.activity == 'finished'
+assert game.dead_players == {'a', 'b'}
+assert game.get_info('a') == {'winners': 'citizens'}
+assert gamedb.load_archived_game(active) is None
+assert gamedb.count_games() == {'active': 2, 'finished': 0, 'archived': 1}
+
+maintenance.idle_ttl = 0
+assert maintenance.run() == 2
+assert gamedb.count_games() == {'active': 0, 'finished': 0, 'archived': 3}
+assert gamedb.load_session('token') == {}
+assert gamedb.load_archived_game(waiting).player_roles == \
+        {'a': 'citizen', 'b': 'citizen'}
+assert maintenance.run() == 0
+assert maintenance.archived == 3
+
+# A vote only appends an event, which still keeps the game from expiring
+code = gamedb.new_game()
+with gamedb.lock(code):
+    game = play(gamedb.load_game(code), 'a', 'b', 'c', 'd', 'e')
+    game.start('a')
+    game.perform_action('a', {'player': 'b'})
+    gamedb.save_game(code, game)
+backdate(code, 3600)
+def row():
+    with gamedb.cursor() as c:
+        return c.execute("SELECT version, updated_at FROM games WHERE code = ?",
+                (code,)).fetchone()
+before = row()
+with gamedb.lock(code):
+    game.perform_action('c', {'player': 'd'})
+    gamedb.save_game(code, game)
+assert row() == before
+assert gamedb.load_version(code) == game.version == before[0] + 1
+maintenance = gamedb.Maintenance(finished_ttl=0, idle_ttl=60)
+assert code not in maintenance.expired()
+
+# A timeout replacing that event with a snapshot keeps its time
+with gamedb.lock(code):
+    game.expire_activity()
+    gamedb.save_game(code, game)
+assert row()[0] == game.version and row()[1] > before[1]
+assert code not in maintenance.expired()
+
+# Timeouts alone don't count as playing
+backdate(code, 3600)
+with gamedb.lock(code):
+    game.expire_activity()
+    gamedb.save_game(code, game)
+assert code in maintenance.expired()
+assert gamedb.archive_game(code)
+
+# Games in use are skipped
+code = gamedb.new_game()
+backdate(code, 10)
+with gamedb.lock(code):
+    assert not gamedb.archive_game(code)
+    assert maintenance.run() == 0
+assert gamedb.archive_game(code)
+
+print('OK')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import os
+import tempfile
+import time
+import gamedb
+from game import Game
+
+
+def new_game():
+    game = Game()
+    for n in ('a', 'b', 'c', 'd', 'e'):
+        game.add_player(n)
+    game.start('a')
+    return game
+
+
+# A timeout kills the player with the most votes, if there's only one
+game = new_game()
+game.perform_action('a', {'player': 'b'})
+assert game.activity == 'vote'
+game.perform_action('c', {'player': 'd'})
+game.perform_action('e', {'player': 'd'})
+game.perform_action('d', {'player': 'c'})
+game.expire_activity()
+assert game.activity == 'wolves'
+assert game.dead_players == {'b', 'd'}
+
+# Nobody dies on a tie, but the game moves on
+game = new_game()
+game.perform_action('a', {'player': 'b'})
+for voter, target in (('a', 'c'), ('c', 'a'), ('d', 'c'), ('e', 'a')):
+    game.perform_action(voter, {'player': target})
+assert game.activity == 'vote'
+game.expire_activity()
+assert game.activity == 'wolves'
+assert game.dead_players == {'b'}
+
+# Timeouts are replayed from the event log
+game = new_game()
+events = game.drain_events()
+game.expire_activity()
+events += game.drain_events()
+replay = Game()
+for version, event in events:
+    replay.apply_event(event)
+assert replay.activity == game.activity == 'vote'
+assert replay.version == game.version
+
+
+# The timers expire games that are due and survive a restart
+gamedb.configure(path=os.path.join(tempfile.mkdtemp(), 'games.db'))
+gamedb.migrate_schema()
+durations = {'wolves': 0.2, 'vote': 60}
+gamedb.start_timers(durations)
+code = gamedb.new_game()
+with gamedb.lock(code):
+    game = gamedb.load_game(code)
+    for n in ('a', 'b', 'c', 'd', 'e'):
+        game.add_player(n)
+    game.start('a')
+    gamedb.save_game(code, game)
+assert gamedb.timers.deadline(code) is not None
+time.sleep(0.5)
+with gamedb.lock(code):
+    assert gamedb.load_game(code).activity == 'vote'
+deadline = gamedb.timers.deadline(code)
+gamedb.timers.stop()
+gamedb.start_timers(durations)
+assert gamedb.timers.deadline(code) == deadline
+gamedb.timers.stop()
+
+# Abandoned games stop timing out after max_idle timeouts, and timeouts
+# don't keep them from being archived
+gamedb.timers = gamedb.PhaseTimers({'wolves': 0.1, 'vote': 0.1}, max_idle=3)
+gamedb.timers.start()
+code = gamedb.new_game()
+with gamedb.lock(code):
+    game = gamedb.load_game(code)
+    for n in ('a', 'b', 'c', 'd', 'e'):
+        game.add_player(n)
+    game.start('a')
+    gamedb.save_game(code, game)
+    version = game.version
+with gamedb.cursor() as c:
+    c.execute("UPDATE games SET updated_at = datetime('now', '-1 hour') WHERE code = ?",
+            (code,))
+time.sleep(0.8)
+assert gamedb.timers.deadline(code) is None
+assert gamedb.load_version(code) == version + 3
+assert code in gamedb.Maintenance(idle_ttl=60).expired()
+gamedb.timers.stop()
+gamedb.timers = gamedb.PhaseTimers({'wolves': 0.1, 'vote': 0.1}, max_idle=3)
+gamedb.timers.start()
+assert gamedb.timers.deadline(code) is None
+
+# Playing starts the timers again
+with gamedb.lock(code):
+    game = gamedb.load_game(code)
+    game.perform_action('a', {'player': 'b'})
+    gamedb.save_game(code, game)
+assert gamedb.timers.deadline(code) is not None
+assert code not in gamedb.Maintenance(idle_ttl=60).expired()
+gamedb.timers.stop()
+
+print('OK')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import os
+import sqlite3
+import tempfile
+from threading import Event, Thread
+from gamedb import ConnectionPool
+
+
+pool = ConnectionPool(os.path.join(tempfile.mkdtemp(), 'games.db'), size=1)
+
+# A thread waiting for the pool gets the slot of a connection that failed
+# to open
+connect = pool._connect
+connecting = Event()
+fail = Event()
+def failing_connect():
+    connecting.set()
+    fail.wait()
+    raise sqlite3.OperationalError('unable to open database file')
+pool._connect = failing_connect
+
+errors = []
+def use_pool():
+    try:
+        with pool.cursor() as c:
+            c.execute('SELECT 1')
+    except sqlite3.Error as e:
+        errors.append(e)
+
+first = Thread(target=use_pool)
+first.start()
+connecting.wait()
+pool._connect = connect
+second = Thread(target=use_pool)
+second.start()
+while pool.stats()['waits'] == 0:
+    pass
+fail.set()
+first.join()
+second.join(5)
+assert not second.is_alive()
+assert len(errors) == 1
+assert pool.stats()['open'] == 1
+
+# Connections in use when the pool is closed are closed on release
+with pool.cursor() as c:
+    pool.close()
+    assert pool.stats()['open'] == 1
+    c.execute('SELECT 1')
+assert pool.stats()['open'] == 0
+try:
+    c.execute('SELECT 1')
+    assert False
+except sqlite3.ProgrammingError:
+    pass
+
+print('OK')
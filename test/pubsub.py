@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+from threading import Thread
+from hub import Hub
+
+
+hub = Hub()
+
+# Publishing without subscribers is a no-op
+hub.publish('abcdef')
+assert hub.subscriber_count() == 0
+
+with hub.subscribe('abcdef') as sub:
+    assert hub.subscriber_count('abcdef') == 1
+
+    # Nothing happened yet
+    assert not sub.wait(0.01)
+
+    # Other games don't wake us up
+    hub.publish('ghijkl')
+    assert not sub.wait(0.01)
+
+    # A publish from another thread does
+    t = Thread(target=hub.publish, args=('abcdef',))
+    t.start()
+    assert sub.wait(5)
+    t.join()
+
+    # Changes made between waits are not lost
+    hub.publish('abcdef')
+    hub.publish('abcdef')
+    assert sub.wait(0)
+    assert not sub.wait(0)
+
+assert hub.subscriber_count() == 0
+
+
+# Coroutine subscribers are woken by publishers on other threads
+import asyncio
+
+async def wait_async():
+    with hub.subscribe_async('abcdef') as sub:
+        assert not await sub.wait(0.01)
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, hub.publish, 'abcdef')
+        assert await sub.wait(5)
+        assert not await sub.wait(0)
+
+asyncio.run(wait_async())
+assert hub.subscriber_count() == 0
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import socket
+import cluster
+import codes
+from hub import Hub
+
+
+# Every code has exactly one owner and the games are spread evenly
+nodes = {'a': 'http://a', 'b': 'http://b', 'c': 'http://c'}
+workers = [cluster.Cluster(n, nodes) for n in nodes]
+owned = {n: 0 for n in nodes}
+for i in range(3000):
+    code = codes.encode(i * 7919)
+    owners = [w.node for w in workers if w.owns(code)]
+    assert len(owners) == 1
+    owned[owners[0]] += 1
+assert all(600 < n < 1400 for n in owned.values()), owned
+
+# Adding a worker only moves games to the new worker
+ring = cluster.HashRing(['a', 'b', 'c'])
+bigger = cluster.HashRing(['a', 'b', 'c', 'd'])
+for i in range(3000):
+    code = codes.encode(i * 7919)
+    assert bigger.owner(code) in (ring.owner(code), 'd')
+
+# Without other workers everything is owned locally
+assert cluster.Cluster().owns('abcdef')
+
+
+# Updates published on one hub reach subscribers of the others
+broker = []
+hubs = [Hub(), Hub()]
+for hub in hubs:
+    hub.attach(cluster.LocalFanOut(broker))
+forgotten = []
+hubs[1].on_remote(forgotten.append)
+
+with hubs[1].subscribe('abcdef') as subscription:
+    assert not subscription.wait(0)
+    hubs[0].publish('abcdef')
+    assert subscription.wait(0)
+    assert forgotten == ['abcdef']
+    hubs[1].publish('abcdef')
+    assert subscription.wait(0)
+    assert forgotten == ['abcdef']
+
+
+# An owner that can't be reached or doesn't answer fails the request
+# instead of the worker forwarding it
+listener = socket.socket()
+listener.bind(('127.0.0.1', 0))
+port = listener.getsockname()[1]
+worker = cluster.Cluster('b', {'a': f'http://127.0.0.1:{port}', 'b': 'http://b'})
+code = next(codes.encode(i) for i in range(100) if not worker.owns(codes.encode(i)))
+listener.listen()
+status, headers, body = worker.forward(code, 'GET', '/', {}, b'', 0.2)
+assert status == 503 and ('Retry-After', '1') in headers
+listener.close()
+status, headers, body = worker.forward(code, 'GET', '/', {}, b'', 0.2)
+assert status == 502
+
+print('OK')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import random
+from game import Game, GameException, GameView
+
+
+class Reference:
+    """
+    The rules written out plainly: wolves agree on a victim at night, then
+    everyone votes on one. A timeout kills the single leader, if any.
+    """
+
+    def __init__(self, names: list, wolf: str):
+        self.roles = {n: 'wolf' if n == wolf else 'citizen' for n in names}
+        self.dead = set()
+        self.activity = 'wolves'
+        self.votes = {}
+        self.winners = None
+
+
+    def voters(self) -> list:
+        return [n for n, r in self.roles.items() if n not in self.dead and
+                (self.activity == 'vote' or r == 'wolf')]
+
+
+    def act(self, player: str, target: str) -> bool:
+        if self.activity == 'finished' or player not in self.voters() or \
+                target not in self.roles or target in self.dead:
+            return False
+        self.votes[player] = target
+        if len(self.votes) == len(self.voters()):
+            leaders = self.leaders()
+            if len(leaders) == 1 and (self.activity == 'vote' or
+                    len(set(self.votes.values())) == 1):
+                self.end(leaders[0])
+        return True
+
+
+    def expire(self) -> None:
+        leaders = self.leaders()
+        self.end(leaders[0] if len(leaders) == 1 else None)
+
+
+    def leaders(self) -> list:
+        counts = {}
+        for target in self.votes.values():
+            counts[target] = counts.get(target, 0) + 1
+        most = max(counts.values(), default=0)
+        return [t for t, c in counts.items() if c == most]
+
+
+    def end(self, victim: str) -> None:
+        if victim is not None:
+            self.dead.add(victim)
+        self.votes = {}
+        alive = [r for n, r in self.roles.items() if n not in self.dead]
+        wolves = alive.count('wolf')
+        if wolves == 0:
+            self.winners = 'citizens'
+        elif wolves >= len(alive) - wolves:
+            self.winners = 'wolves'
+        if self.winners is not None:
+            self.activity = 'finished'
+        else:
+            self.activity = 'vote' if self.activity == 'wolves' else 'wolves'
+
+
+    def info(self, player: str) -> dict:
+        if self.activity == 'finished':
+            return {'winners': self.winners}
+        if self.activity == 'wolves' and self.roles.get(player) != 'wolf':
+            return {}
+        counts = {}
+        for target in self.votes.values():
+            counts[target] = counts.get(target, 0) + 1
+        alive = [n for n in self.roles if n not in self.dead]
+        return {
+                'vote': self.votes.get(player),
+                'vote_count': counts,
+                'options': [] if player in self.dead else alive,
+            }
+
+
+# Starting deals the roles with a count, here one wolf
+game = Game()
+for n in ('a', 'b', 'c', 'd'):
+    game.add_player(n)
+for dealt in (('a', 'b'), ('x',)):
+    try:
+        game.start(*dealt)
+        assert False
+    except GameException:
+        pass
+assert game.activity == 'waiting'
+game.start()
+assert sorted(game.player_roles.values()) == ['citizen'] * 3 + ['wolf']
+
+
+# Seeded games of random, mostly invalid, actions and timeouts follow the
+# reference, and survive serialization and replay
+for seed in range(30):
+    rng = random.Random(seed)
+    names = [f'p{i}' for i in range(rng.choice([4, 5, 9, 20]))]
+    wolf = rng.choice(names)
+    game = Game()
+    for n in names:
+        game.add_player(n)
+    game.start(wolf)
+    reference = Reference(names, wolf)
+    while reference.activity != 'finished':
+        if rng.random() < 0.05:
+            game.expire_activity()
+            reference.expire()
+        else:
+            player, target = rng.choice(names + ['x']), rng.choice(names + ['x'])
+            try:
+                game.perform_action(player, {'player': target})
+                done = True
+            except GameException:
+                done = False
+            assert done == reference.act(player, target), (seed, player, target)
+        assert game.activity == reference.activity
+        assert game.dead_players == reference.dead
+        view = GameView(game.serialize('binary'))
+        loaded = Game(game.serialize('json'))
+        for n in names + ['x']:
+            info = reference.info(n)
+            assert game.get_info(n) == info, (seed, n)
+            assert view.get_info(n) == info
+            assert loaded.get_info(n) == info
+    replay = Game()
+    for version, event in game.drain_events():
+        replay.apply_event(event)
+    assert replay.serialize('binary') == game.serialize('binary')
+    assert replay.version == game.version
+
+print('OK')
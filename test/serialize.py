@@ -3,7 +3,7 @@
 import sys
 import json
 sys.path.append("..")
-from game import Game
+from game import Game, GameException
 
 
 game = Game()
@@ -22,3 +22,32 @@ assert len(json.loads(serialized)['players']) == 1
 assert serialized == game_loaded.serialize()
 assert game.serialize() == game_loaded.serialize()
 assert serialized == game.serialize()
+
+
+game = Game()
+for name in ('foo', 'bar', 'baz', 'qux'):
+    game.add_player(name)
+game.start()
+serialized = game.serialize('binary')
+game_loaded = Game(serialized)
+assert serialized == game_loaded.serialize('binary')
+assert game.serialize() == game_loaded.serialize()
+assert game.player_roles == game_loaded.player_roles
+assert len(serialized) < len(game.serialize())
+
+
+game = Game()
+try:
+    game.add_player('x' * 70000)
+    assert False
+except GameException:
+    pass
+assert game.player_count == 0
+
+
+# Games joined before the limits were checked fall back to JSON
+game = Game()
+game._intern('x' * 70000, 0)
+serialized = game.serialize('binary')
+assert type(serialized) == str
+assert Game(serialized).player_roles == game.player_roles
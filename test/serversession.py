@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+from sessions import MemoryStore, ServerSession
+
+
+store = MemoryStore()
+
+# A new session only gets a token once something is stored
+session = ServerSession(store)
+assert session.get('abcdef') is None
+assert 'abcdef' not in session
+session['abcdef'] = 'Foo'
+session['ghijkl'] = 'Bar'
+assert session.modified
+store.update('token', session._changes)
+
+# Names are read one game at a time
+session = ServerSession(store, 'token')
+assert session.get('abcdef') == 'Foo'
+assert session._names == {'abcdef': 'Foo'}
+assert dict(session) == {'abcdef': 'Foo', 'ghijkl': 'Bar'}
+assert not session.modified
+
+# Archiving a game removes it from every session playing it
+other = ServerSession(store)
+other['abcdef'] = 'Baz'
+store.update('other', other._changes)
+store.discard_game('abcdef')
+assert ServerSession(store, 'token').get('abcdef') is None
+assert ServerSession(store, 'token').get('ghijkl') == 'Bar'
+assert len(ServerSession(store, 'other')) == 0
+assert 'other' not in store._sessions
+
+print('OK')
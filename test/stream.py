@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import sys
+# test/api.py would shadow the module
+sys.path.insert(0, "..")
+from api import _diff, _event
+
+
+# Delta events hold the fields that changed, removed fields as None
+old = {'activity': 'vote', 'players': ['a', 'b'],
+        'state': {'vote': None, 'vote_count': {}, 'options': ['a', 'b']}}
+new = {'activity': 'vote', 'players': ['a', 'b'],
+        'state': {'vote': 'b', 'vote_count': {'b': 1}, 'options': ['a', 'b']}}
+assert _diff(old, new) == {'state': {'vote': 'b', 'vote_count': {'b': 1}}}
+assert _diff(new, new) == {}
+assert _diff(new, {'activity': 'finished', 'players': ['a', 'b'],
+        'state': {'winners': 'wolves'}}) == {'activity': 'finished',
+        'state': {'vote': None, 'vote_count': None, 'options': None,
+            'winners': 'wolves'}}
+# Only dicts are merged, a changed list is sent whole
+assert _diff({'options': ['a', 'b']}, {'options': ['a']}) == {'options': ['a']}
+assert _diff({'state': {}}, {'state': {'vote': None}}) == {'state': {'vote': None}}
+
+assert _event(b'{}', 3) == b'id: 3\ndata: {}\n\n'
+assert _event(b'{}', 4, 'delta') == b'id: 4\nevent: delta\ndata: {}\n\n'
+
+print('OK')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import sys
+sys.path.append("..")
+import json
+import encoding
+from game import Game, GameView
+from views import ViewCache
+
+
+cache = ViewCache()
+game = Game()
+names = ['a', 'b', 'c', 'd', 'e']
+for n in names:
+    game.add_player(n)
+game.start('a')
+
+def check(player):
+    view = cache.get('abcdef', game, player)
+    assert json.loads(view.data) == view.info
+    info = {'activity': game.activity, 'players': names}
+    if player is not None:
+        info['name'] = player
+        info['state'] = game.get_info(player)
+    assert view.info == info, (view.info, info)
+    return view
+
+# Citizens share a view during the wolves activity
+for n in names + [None]:
+    check(n)
+assert check('b').data.startswith(check('c').data[:-len(',"name":"c"}')])
+assert cache.get('abcdef', game, 'b').info['state'] is \
+        cache.get('abcdef', game, 'c').info['state']
+
+# A new version invalidates the views
+game.perform_action('a', {'player': 'b'})
+assert game.activity == 'vote'
+for n in names + [None]:
+    check(n)
+game.perform_action('c', {'player': 'a'})
+assert check('c').info['state']['vote'] == 'a'
+assert check('d').info['state']['vote'] is None
+
+# Discarded games are built again
+view = check('c')
+cache.discard('abcdef')
+assert 'abcdef' not in cache._games
+rebuilt = check('c')
+assert rebuilt.info == view.info
+assert rebuilt.info['state'] is not view.info['state']
+
+# A GameView of a stored game gives the same info as the game itself
+def check_view(game):
+    for format in ('json', 'binary'):
+        view = GameView(game.serialize(format))
+        assert view.activity == game.activity
+        assert view.version == game.version
+        assert view.player_count == len(names)
+        assert view.player_roles == game.player_roles
+        assert view.dead_players == game.dead_players
+        for n in names + ['x']:
+            assert view.view_class(n) == game.view_class(n)
+            if game.activity != 'wolves' or n != 'x':
+                assert view.get_info(n) == game.get_info(n), (n, format)
+
+game = Game()
+for n in names:
+    game.add_player(n)
+check_view(game)
+game.start('a')
+check_view(game)
+game.perform_action('a', {'player': 'b'})
+check_view(game)
+for n in ('a', 'c', 'd'):
+    game.perform_action(n, {'player': 'e'})
+    check_view(game)
+game.perform_action('e', {'player': 'c'})
+check_view(game)
+game.perform_action('a', {'player': 'c'})
+check_view(game)
+assert game.activity == 'finished'
+
+
+# Both encoders give the same output
+value = {'players': ['ä', 'b"'], 'state': {'vote': None, 'n': 3}}
+fast = encoding.dumps(value)
+orjson, encoding.orjson = encoding.orjson, None
+assert encoding.dumps(value) == fast
+assert encoding.dumps_object({'players': encoding.fragment(value['players']),
+        'state': value['state']}) == fast
+encoding.orjson = orjson
+
+print('OK')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Cache of the game info sent to players.
+
+Players of the same view class (see Game.view_class) get the same info,
+apart from their own name. The info of each class is built and encoded once
+per version of a game and shared by every request and stream of that class.
+"""
+
+import encoding
+from collections import OrderedDict
+from game import Game
+from threading import Lock
+
+
+class View:
+
+    def __init__(self, info: dict, data: bytes):
+        self.info = info
+        self.data = data
+
+
+class GameViews:
+
+    def __init__(self, version: int, roster=None):
+        self.version = version
+        self.views = {}
+        # (player count, list of names, encoded list), only changes while
+        # players join
+        self.roster = roster
+
+
+class ViewCache:
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._mutex = Lock()
+        # code -> GameViews of the latest version seen
+        self._games = OrderedDict()
+
+
+    def get(self, code: str, game: Game, player: str = None) -> View:
+        """
+        Return the info of the game as seen by a player, or by someone who
+        hasn't joined if player is None. The caller must hold the game lock.
+        """
+        key = 'spectator' if player is None else game.view_class(player)
+        if key is None:
+            # Not part of the game, get_info decides what these may see
+            key = 'unknown'
+        with self._mutex:
+            entry = self._games.get(code)
+            if entry is None or entry.version != game.version:
+                entry = self._games[code] = GameViews(game.version,
+                        None if entry is None else entry.roster)
+                if len(self._games) > self.size:
+                    self._games.popitem(last=False)
+            else:
+                self._games.move_to_end(code)
+            view = entry.views.get(key)
+        if view is None:
+            view = entry.views[key] = _build(game, entry, player)
+        if player is None:
+            return view
+        return View({**view.info, 'name': player},
+                view.data[:-1] + b',"name":' + encoding.dumps(player) + b'}')
+
+
+    def discard(self, code: str) -> None:
+        """
+        Forget the views of a game, e.g. once it is archived.
+        """
+        with self._mutex:
+            self._games.pop(code, None)
+
+
+def _build(game: Game, entry: GameViews, player: str) -> View:
+    roster = entry.roster
+    if roster is None or roster[0] != game.player_count:
+        players = list(game.player_roles)
+        roster = entry.roster = (len(players), players, encoding.fragment(players))
+    info = {'activity': game.activity, 'players': roster[1]}
+    fields = {'activity': game.activity, 'players': roster[2]}
+    if player is not None or game.activity == 'finished':
+        info['state'] = fields['state'] = game.get_info(player)
+    return View(info, encoding.dumps_object(fields))
+
+
+views = ViewCache()
@@ -6,6 +6,9 @@ from flask import Flask, redirect, url_for, render_template, request, session
 from flask_babel import Babel, gettext
 from game import Game
 from api import api
+from sessions import ServerSessionInterface
+import gamedb
+import stats
 
 
 def eprint(*args, **kwargs):
@@ -14,10 +17,9 @@ def eprint(*args, **kwargs):
 
 app = Flask(__name__)
 app.secret_key = open('secret.key').read()
+app.session_interface = ServerSessionInterface()
 app.register_blueprint(api, url_prefix='/api')
 babel = Babel(app)
-games = {}
-total_games = 0
 
 
 @babel.localeselector
@@ -33,9 +35,44 @@ def index(code: str = None):
 
 @app.route('/status/')
 def get_status():
-    return render_template('status.html', game_count=len(api.games),
-            total_game_count=api.total_games)
+    counts = gamedb.count_games()
+    return render_template('status.html', game_count=counts['active'],
+            total_game_count=stats.registry.counter('games_created_total'),
+            waiting_game_count=gamedb.count_activities().get('waiting', 0),
+            finished_game_count=counts['finished'],
+            archived_game_count=counts['archived'],
+            subscriber_count=gamedb.hub.subscriber_count())
 
 
 if __name__ == '__main__':
-    app.run(port=5000, threaded=True, host='0.0.0.0')
+    import argparse
+    import cluster
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--node', help='name of this worker')
+    parser.add_argument('--cluster', metavar='NAME=URL,...',
+            help='all workers sharing the database, including this one')
+    parser.add_argument('--broker', metavar='URL',
+            help='Redis compatible server used to share game updates')
+    parser.add_argument('--proxies', type=int, default=0,
+            help='number of reverse proxies in front, whose X-Forwarded-For is trusted')
+    parser.add_argument('--durations', metavar='ACTIVITY=SECONDS,...',
+            help='time each activity may take, e.g. wolves=120,vote=300')
+    args = parser.parse_args()
+    if args.proxies > 0:
+        # Client addresses are used by the admission limits
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=args.proxies)
+    if args.cluster is not None:
+        if args.node is None or args.broker is None:
+            parser.error('--cluster requires --node and --broker')
+        nodes = dict(n.split('=', 1) for n in args.cluster.split(','))
+        cluster.configure(args.node, nodes,
+                cluster.RedisFanOut(args.broker, args.node))
+    gamedb.start_maintenance()
+    durations = None
+    if args.durations is not None:
+        durations = {a: float(d) for a, d in
+                (p.split('=', 1) for p in args.durations.split(','))}
+    gamedb.start_timers(durations)
+    app.run(port=args.port, threaded=True, host='0.0.0.0')